@@ -0,0 +1,218 @@
+"""ai.py - Built-in computer opponent.
+
+Negamax search with alpha-beta pruning over engine.Board. Positions are
+cached in a transposition table keyed on the canonical form of the board:
+the smallest of its 8 rotations and reflections, so symmetric positions
+share one entry. The table is module level and therefore survives across
+requests served by the same instance. Each move is bounded by a node and a
+time budget; the search deepens iteratively and plays the best move of the
+deepest completed iteration."""
+
+import threading
+import time
+
+from engine import other
+
+AI_USER_NAME = 'computer'
+
+NODE_BUDGET = 200000
+TIME_BUDGET = 0.5  # seconds
+# About 370 bytes per entry on Python 2.7, so the table stays near 20MB,
+# well inside the 128MB of an F1 instance
+MAX_TABLE_SIZE = 50000
+
+WIN_SCORE = 1000
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# (size, win_length, x bits, o bits) -> (depth, flag, score, best cell),
+# in two generations of up to MAX_TABLE_SIZE / 2 entries: the current one
+# and the previous one. When the current one is full the previous one is
+# dropped, so the oldest positions are evicted first and a hit in the
+# previous generation moves the position to the current one.
+_generations = [{}, {}]
+_symmetries = {}
+_symmetries_lock = threading.Lock()
+
+
+class _OutOfBudget(Exception):
+    pass
+
+
+def symmetries(size):
+    """Returns the 8 cell permutations (rotations and reflections) of a
+    size x size board. perm[cell] is where cell moves to."""
+    perms = _symmetries.get(size)
+    if perms is None:
+        with _symmetries_lock:
+            perms = []
+            for transform in (lambda r, c: (r, c),
+                              lambda r, c: (c, size - 1 - r),
+                              lambda r, c: (size - 1 - r, size - 1 - c),
+                              lambda r, c: (size - 1 - c, r),
+                              lambda r, c: (r, size - 1 - c),
+                              lambda r, c: (size - 1 - r, c),
+                              lambda r, c: (c, r),
+                              lambda r, c: (size - 1 - c, size - 1 - r)):
+                perm = []
+                for cell in range(size * size):
+                    r, c = transform(*divmod(cell, size))
+                    perm.append(r * size + c)
+                perms.append(perm)
+            _symmetries[size] = perms
+    return perms
+
+
+def _permute(bits, perm):
+    result = 0
+    while bits:
+        low = bits & -bits
+        result |= 1 << perm[low.bit_length() - 1]
+        bits ^= low
+    return result
+
+
+def canonical(board):
+    """Returns (key, perm) where key identifies the board up to symmetry
+    and perm maps the board's cells onto the canonical orientation"""
+    best = None
+    for perm in symmetries(board.size):
+        key = (_permute(board.stones['X'], perm),
+               _permute(board.stones['O'], perm))
+        if best is None or key < best[0]:
+            best = (key, perm)
+    key, perm = best
+    return (board.size, board.win_length) + key, perm
+
+
+def _candidate_moves(board):
+    """Free cells, nearest to the centre first. On large boards only cells
+    next to an existing stone are considered."""
+    n = board.size
+    centre = (n - 1) / 2.0
+    cells = list(board.free_cells())
+    if n > 5 and board.moves:
+        occupied = board.occupied
+        near = []
+        for cell in cells:
+            r, c = divmod(cell, n)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    rr, cc = r + dr, c + dc
+                    if (0 <= rr < n and 0 <= cc < n and
+                            occupied >> (rr * n + cc) & 1):
+                        near.append(cell)
+                        break
+                else:
+                    continue
+                break
+        cells = near
+    cells.sort(key=lambda cell: abs(cell // n - centre) + abs(cell % n - centre))
+    return cells
+
+
+def _lookup(key):
+    current, previous = _generations
+    entry = current.get(key)
+    if entry is None:
+        entry = previous.get(key)
+        if entry is not None:
+            _store(key, entry)
+    return entry
+
+
+def _store(key, entry):
+    if len(_generations[0]) >= MAX_TABLE_SIZE // 2:
+        _generations[:] = [{}, _generations[0]]
+    _generations[0][key] = entry
+
+
+class _Search(object):
+
+    def __init__(self, node_budget, time_budget):
+        self.node_budget = node_budget
+        self.deadline = time.time() + time_budget
+        self.nodes = 0
+
+    def negamax(self, board, letter, depth, alpha, beta):
+        self.nodes += 1
+        if self.nodes > self.node_budget or (
+                self.nodes & 63 == 0 and time.time() > self.deadline):
+            raise _OutOfBudget()
+
+        key, perm = canonical(board)
+        entry = _lookup(key)
+        hint = None
+        if entry is not None:
+            entry_depth, flag, score, best = entry
+            hint = perm.index(best) if best is not None else None
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return score, hint
+                elif flag == LOWER:
+                    alpha = max(alpha, score)
+                elif flag == UPPER:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score, hint
+
+        moves = _candidate_moves(board)
+        if hint is not None and hint in moves:
+            moves.remove(hint)
+            moves.insert(0, hint)
+
+        original_alpha = alpha
+        best_score, best_cell = -WIN_SCORE - 1, None
+        for cell in moves:
+            if board.play(cell, letter):
+                score = WIN_SCORE - board.moves
+            elif board.is_full:
+                score = 0
+            elif depth <= 1:
+                score = 0
+            else:
+                score = -self.negamax(board, other(letter), depth - 1,
+                                      -beta, -alpha)[0]
+            board.undo(cell, letter)
+            if score > best_score:
+                best_score, best_cell = score, cell
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        _store(key, (depth, flag, best_score,
+                     perm[best_cell] if best_cell is not None else None))
+        return best_score, best_cell
+
+
+def choose_move(board, letter, node_budget=NODE_BUDGET,
+                time_budget=TIME_BUDGET):
+    """Returns the cell the computer plays for letter on board"""
+    board = board.copy()
+    moves = _candidate_moves(board)
+    best_cell = moves[0]
+    search = _Search(node_budget, time_budget)
+    remaining = board.cells - board.moves
+    for depth in range(1, remaining + 1):
+        try:
+            score, cell = search.negamax(board, letter, depth,
+                                         -WIN_SCORE - 1, WIN_SCORE + 1)
+        except _OutOfBudget:
+            break
+        if cell is not None:
+            best_cell = cell
+        if abs(score) > WIN_SCORE - board.cells - 1:
+            break  # forced result found, deeper search can't change it
+    return best_cell
+
+
+def play_move(board, letter, **budget):
+    """Chooses and plays the computer's move. Returns (cell, won)."""
+    cell = choose_move(board, letter, **budget)
+    return cell, board.play(cell, letter)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""analysis.py - Offline, vectorized analysis of exported games and scores.
+
+Reads Game and Score exports (NDJSON, optionally gzipped, one entity per
+line) without any datastore access. Games are grouped by board size and win
+length and replayed in chunks as NumPy arrays: one row per game, one column
+per cell. Every k-in-a-row window of the board is a row of a 0/1 window
+matrix, so the stones each player has in every window of every game is a
+single matrix product, and wins, open threats and blunders are comparisons
+on that product.
+
+Game records need "board_size", "win_length" (defaults to the engine's)
+and "history", a list of cells in the order they were played (X first).
+Score records need "date" (YYYY-MM-DD) and "result".
+
+    python analysis.py games.ndjson.gz [...] [--scores scores.ndjson.gz]
+        [--out analysis] [--chunk 100000]
+
+Writes results_by_size.csv, openings.csv, blunders_by_ply.csv and, with
+--scores, scores_by_month.csv to the output directory."""
+
+import argparse
+import collections
+import csv
+import gzip
+import json
+import os
+
+import numpy as np
+
+from engine import DIRECTIONS
+from engine import default_win_length
+
+X_WIN, O_WIN, TIE, UNFINISHED = 0, 1, 2, 3
+OUTCOMES = ('x_wins', 'o_wins', 'ties', 'unfinished')
+
+
+def read_ndjson(path):
+    """Yields one dict per line of a (gzipped) NDJSON file"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as lines:
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def window_matrix(size, win_length):
+    """Returns a (windows, cells) uint8 matrix with a row per k-in-a-row
+    window of a size x size board"""
+    windows = []
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in DIRECTIONS:
+                end_row = row + d_row * (win_length - 1)
+                end_col = col + d_col * (win_length - 1)
+                if 0 <= end_row < size and 0 <= end_col < size:
+                    window = np.zeros(size * size, dtype=np.uint8)
+                    for i in range(win_length):
+                        window[(row + d_row * i) * size + col + d_col * i] = 1
+                    windows.append(window)
+    return np.array(windows, dtype=np.uint8)
+
+
+def analyse_chunk(size, win_length, histories):
+    """Replays a chunk of games on the same board.
+    Returns a dict of arrays:
+        outcome: (games,) one of X_WIN, O_WIN, TIE, UNFINISHED
+        length: (games,) moves played
+        opening: (games,) first cell, -1 for empty games
+        missed_win: (games, plies) mover had a winning cell and didn't win
+        missed_block: (games, plies) opponent could win next move and
+            the move neither won nor removed every such threat"""
+    cells = size * size
+    games = len(histories)
+    plies = max(len(history) for history in histories) if histories else 0
+    moves = np.full((games, max(plies, 1)), -1, dtype=np.int16)
+    for i, history in enumerate(histories):
+        moves[i, :len(history)] = history
+    length = (moves >= 0).sum(axis=1)
+    windows = window_matrix(size, win_length).T.astype(np.int16)
+
+    stones = np.zeros((2, games, cells), dtype=np.int16)
+    outcome = np.full(games, UNFINISHED, dtype=np.int8)
+    missed_win = np.zeros((games, plies), dtype=bool)
+    missed_block = np.zeros((games, plies), dtype=bool)
+    rows = np.arange(games)
+    for ply in range(plies):
+        mover, opponent = ply % 2, 1 - ply % 2
+        live = (moves[:, ply] >= 0) & (outcome == UNFINISHED)
+        if not live.any():
+            break
+        own = np.dot(stones[mover], windows)
+        opp = np.dot(stones[opponent], windows)
+        could_win = ((own == win_length - 1) & (opp == 0)).any(axis=1)
+
+        played = rows[live]
+        stones[mover, played, moves[live, ply]] = 1
+        own = np.dot(stones[mover], windows)
+        won = live & (own == win_length).any(axis=1)
+        threat_left = ((opp == win_length - 1) & (own == 0)).any(axis=1)
+
+        missed_win[:, ply] = live & could_win & ~won
+        missed_block[:, ply] = live & ~won & threat_left
+        outcome[won] = X_WIN if mover == 0 else O_WIN
+    outcome[(outcome == UNFINISHED) & (length == cells)] = TIE
+    return {
+        'outcome': outcome,
+        'length': length,
+        'opening': moves[:, 0].astype(np.int32),
+        'missed_win': missed_win,
+        'missed_block': missed_block,
+    }
+
+
+class Summary(object):
+    """Accumulates per-chunk results into the summary tables"""
+
+    def __init__(self):
+        self.results = collections.defaultdict(lambda: np.zeros(4, np.int64))
+        self.lengths = collections.defaultdict(int)
+        self.openings = collections.defaultdict(lambda: np.zeros(4, np.int64))
+        self.blunders = collections.defaultdict(lambda: np.zeros(3, np.int64))
+
+    def add(self, board, result):
+        outcome = result['outcome']
+        self.results[board] += np.bincount(outcome, minlength=4)
+        self.lengths[board] += int(result['length'].sum())
+
+        started = result['opening'] >= 0
+        cells = board[0] * board[0]
+        counts = np.zeros((cells, 4), dtype=np.int64)
+        np.add.at(counts, (result['opening'][started], outcome[started]), 1)
+        for cell in np.nonzero(counts.sum(axis=1))[0]:
+            self.openings[board + (int(cell),)] += counts[cell]
+
+        positions = np.zeros(result['missed_win'].shape[1], np.int64)
+        lengths = result['length']
+        for ply in range(len(positions)):
+            positions[ply] = int((lengths > ply).sum())
+        for ply, (total, wins, blocks) in enumerate(zip(
+                positions, result['missed_win'].sum(axis=0),
+                result['missed_block'].sum(axis=0))):
+            self.blunders[board + (ply,)] += [total, wins, blocks]
+
+    def write(self, out_dir):
+        with open(os.path.join(out_dir, 'results_by_size.csv'), 'w') as out:
+            writer = csv.writer(out)
+            writer.writerow(['board_size', 'win_length', 'games'] +
+                            list(OUTCOMES) +
+                            ['x_win_rate', 'o_win_rate', 'tie_rate',
+                             'first_move_advantage', 'average_moves'])
+            for board, counts in sorted(self.results.items()):
+                games = int(counts.sum())
+                finished = int(counts[:3].sum()) or 1
+                decisive = int(counts[:2].sum()) or 1
+                writer.writerow(list(board) + [games] + counts.tolist() + [
+                    '%.4f' % (counts[X_WIN] / float(finished)),
+                    '%.4f' % (counts[O_WIN] / float(finished)),
+                    '%.4f' % (counts[TIE] / float(finished)),
+                    '%.4f' % (counts[X_WIN] / float(decisive)),
+                    '%.2f' % (self.lengths[board] / float(games or 1))])
+
+        with open(os.path.join(out_dir, 'openings.csv'), 'w') as out:
+            writer = csv.writer(out)
+            writer.writerow(['board_size', 'win_length', 'opening_cell',
+                             'games'] + list(OUTCOMES) + ['x_win_rate'])
+            for key, counts in sorted(self.openings.items()):
+                finished = int(counts[:3].sum()) or 1
+                writer.writerow(list(key) + [int(counts.sum())] +
+                                counts.tolist() +
+                                ['%.4f' % (counts[X_WIN] / float(finished))])
+
+        with open(os.path.join(out_dir, 'blunders_by_ply.csv'), 'w') as out:
+            writer = csv.writer(out)
+            writer.writerow(['board_size', 'win_length', 'ply', 'positions',
+                             'missed_wins', 'missed_blocks'])
+            for key, counts in sorted(self.blunders.items()):
+                writer.writerow(list(key) + counts.tolist())
+
+    def report(self):
+        for board, counts in sorted(self.results.items()):
+            finished = int(counts[:3].sum()) or 1
+            print('{}x{} ({} in a row): {} games, X {:.1%} O {:.1%} '
+                  'tie {:.1%}'.format(board[0], board[0], board[1],
+                                      int(counts.sum()),
+                                      counts[X_WIN] / float(finished),
+                                      counts[O_WIN] / float(finished),
+                                      counts[TIE] / float(finished)))
+
+
+def analyse_games(paths, chunk_size):
+    """Streams game records and analyses them in per-board chunks"""
+    summary = Summary()
+    pending = collections.defaultdict(list)
+    for path in paths:
+        for record in read_ndjson(path):
+            size = int(record.get('board_size') or 3)
+            board = (size, int(record.get('win_length') or
+                               default_win_length(size)))
+            pending[board].append(record.get('history') or [])
+            if len(pending[board]) >= chunk_size:
+                summary.add(board, analyse_chunk(board[0], board[1],
+                                                 pending.pop(board)))
+    for board, histories in pending.items():
+        summary.add(board, analyse_chunk(board[0], board[1], histories))
+    return summary
+
+
+def analyse_scores(paths, out_dir):
+    """Writes monthly result counts of Score exports"""
+    months, results = [], []
+    for path in paths:
+        for record in read_ndjson(path):
+            months.append(record['date'][:7])
+            results.append(record.get('result'))
+    if not months:
+        return
+    months = np.array(months)
+    results = np.array(results, dtype=object)
+    labels, index = np.unique(months, return_inverse=True)
+    with open(os.path.join(out_dir, 'scores_by_month.csv'), 'w') as out:
+        writer = csv.writer(out)
+        writer.writerow(['month', 'games', 'user_x', 'user_o', 'tie'])
+        columns = [np.bincount(index, weights=(results == result),
+                               minlength=len(labels)).astype(np.int64)
+                   for result in ('user_x', 'user_o', 'tie')]
+        totals = np.bincount(index, minlength=len(labels))
+        for row, month in enumerate(labels):
+            writer.writerow([month, int(totals[row])] +
+                            [int(column[row]) for column in columns])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Vectorized analysis of exported games and scores')
+    parser.add_argument('games', nargs='+', help='Game NDJSON export files')
+    parser.add_argument('--scores', nargs='*', default=[],
+                        help='Score NDJSON export files')
+    parser.add_argument('--out', default='analysis')
+    parser.add_argument('--chunk', type=int, default=100000,
+                        help='games replayed per batch')
+    args = parser.parse_args()
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    summary = analyse_games(args.games, args.chunk)
+    summary.write(args.out)
+    summary.report()
+    analyse_scores(args.scores, args.out)
+
+
+if __name__ == '__main__':
+    main()
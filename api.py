@@ -7,30 +7,51 @@ primarily with communication to/from the API's users."""
 import endpoints
 from protorpc import remote, messages
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+import collections
 import json
-
-from models import User, Game, Score
+import time
+
+import ai
+import gamecache
+import leaderboard
+import solver
+import stats
+from models import User, Game, Score, HeadToHead
+from models import GAME_ACTIVE
 from models import (
     StringMessage,
     NewGameForm,
     GameForm,
+    GamePollForm,
+    GameStatsForm,
+    HeadToHeadForm,
+    HintForm,
+    GameMoveForms,
     MakeMoveForm,
+    MoveResultForm,
+    MoveResultForms,
     ScoreForms,
     UserGameFroms,
+    UserRankingForm,
     UserRankingForms,
     GameHistroy
 )
-from utils import get_by_urlsafe
-from utils import isBoardFull
-from utils import isSpaceFree
-from utils import isWinner
+from instrumentation import instrumented
+from instrumentation import RPC_BUDGET
+from utils import fetch_page
+from utils import get_user_names
+from utils import get_key_by_urlsafe
 
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+POLL_GAME_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        version=messages.IntegerField(2),
+        wait=messages.IntegerField(3))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),user=messages.StringField(2),)
@@ -38,8 +59,30 @@ USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 GET_USER_GAMES_REQUEST = endpoints.ResourceContainer(
         urlsafe_user_key=messages.StringField(1),)
-
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+PAGE_REQUEST = endpoints.ResourceContainer(page_size=messages.IntegerField(1),
+                                           cursor=messages.StringField(2))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+        size=messages.IntegerField(1))
+HEAD_TO_HEAD_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        opponent=messages.StringField(2))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        page_size=messages.IntegerField(2),
+        cursor=messages.StringField(3))
+
+MAX_BATCH_MOVES = 500
+# seconds of computer replies per make_moves call, well inside the 60 second
+# request deadline
+MAX_BATCH_AI_TIME = 20
+MAX_POLL_WAIT = 25  # seconds, below the 60 second request deadline
+POLL_INTERVAL = 0.5
+# a long poll reads the cached version once per interval on top of the
+# usual RPCs
+POLL_RPC_BUDGET = RPC_BUDGET + int(MAX_POLL_WAIT / POLL_INTERVAL)
+OUTCOMES = {solver.WIN: 'win', solver.DRAW: 'draw', solver.LOSS: 'loss'}
+RANKING_PROJECTION = [User.name, User.email, User.wins, User.ties,
+                      User.total_played, User.points]
 
 @endpoints.api(name='tic_tac_toe', version='v1')
 class TicTacToeApi(remote.Service):
@@ -49,13 +92,16 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if request.user_name == ai.AI_USER_NAME:
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        try:
+            User.create(request.user_name, request.email)
+        except ValueError as e:
+            raise endpoints.ConflictException(str(e))
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -64,25 +110,25 @@ class TicTacToeApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        user_x = User.get_user_by_name(request.user_x)
-        user_o = User.get_user_by_name(request.user_o)
+        user_x = User.get_key_by_name(request.user_x)
+        computer = _get_computer_key() if request.vs_computer else None
+        user_o = computer or User.get_key_by_name(request.user_o)
         if not (user_x and user_o):
-            wrong_user = user_x if not user_x else user_o
+            wrong_user = request.user_x if not user_x else request.user_o
             raise endpoints.NotFoundException(
-                'User %s does not exist!' % wrong_user.name)
+                'User %s does not exist!' % wrong_user)
 
-        board_size = 3
+        board_size = request.board_size or 3
         try:
-            game = Game.new_game(user_x.key,user_o.key,board_size)
-        except ValueError:
-            raise endpoints.BadRequestException('Something wrong, please check new game form')
-
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        #taskqueue.add(url='/tasks/cache_average_attempts')
+            game = Game.new_game(user_x, user_o, board_size,
+                                 request.win_length, computer)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        gamecache.prime(game)
+        game.publish_version()
         return game.to_form('Good luck playing Tic Tac Toe')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -90,29 +136,89 @@ class TicTacToeApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = gamecache.get(get_key_by_urlsafe(request.urlsafe_game_key, Game))
         if game:
             return game.to_form('Time to make a move!')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=POLL_GAME_REQUEST,
+                      response_message=GamePollForm,
+                      path='game/{urlsafe_game_key}/poll',
+                      name='poll_game',
+                      http_method='GET')
+    @instrumented(budget=POLL_RPC_BUDGET)
+    def poll_game(self, request):
+        """Return the game only if its version is newer than the given one.
+        With wait, holds the request up to that many seconds until a move
+        is made. Unchanged games are answered from memcache."""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        since = request.version if request.version is not None else -1
+        deadline = time.time() + min(max(request.wait or 0, 0), MAX_POLL_WAIT)
+        while True:
+            version = Game.get_cached_version(game_key)
+            if version is None or version > since:
+                game = gamecache.get(game_key)
+                if not game:
+                    raise endpoints.NotFoundException('Game not found!')
+                game.publish_version()
+                version = game.version
+                if version > since:
+                    return GamePollForm(
+                        version=version, modified=True,
+                        game=game.to_form('Time to make a move!'))
+            if time.time() + POLL_INTERVAL > deadline:
+                return GamePollForm(version=version, modified=False)
+            time.sleep(POLL_INTERVAL)
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    def get_hint(self, request):
+        """Return the best move for the player to move and the outcome with
+        perfect play, from the solved-position table of the board"""
+        game = gamecache.get(get_key_by_urlsafe(request.urlsafe_game_key, Game))
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over or game.game_cancelled:
+            raise endpoints.BadRequestException('Game already over!')
+        evaluation = solver.evaluate(game.engine)
+        if evaluation is None:
+            raise endpoints.BadRequestException(
+                'No hints for a {0}x{0} board with {1} in a row'.format(
+                    game.board_size, game.engine.win_length))
+        value, cell, plies = evaluation
+        return HintForm(
+            outcome=OUTCOMES[value], best_move=cell, moves_to_end=plies,
+            next_move=get_user_names([game.next_move])[game.next_move],
+            message='Play {}: {} in {} moves with perfect play'.format(
+                cell, OUTCOMES[value], plies))
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='cancel_game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='GET')
-
-
+    @instrumented
     def cancel_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        try:
+            game = gamecache.cancel(game_key)
+        except datastore_errors.TransactionFailedError as e:
+            raise endpoints.ConflictException(
+                '{}, please try again'.format(e))
         if game:
             if game.game_over:
                 return game.to_form('Game already over!')
             else:
-                game.game_cancel()
+                game.publish_version()
                 return game.to_form('Game has been Cancelled!')
         else:
             raise endpoints.NotFoundException('Game not found!')
@@ -122,73 +228,112 @@ class TicTacToeApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='POST')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        #user = User.query(User.name == request.user).get()
-        user = User.get_user_by_name(request.user)
-
-        if game.game_over:
-            return game.to_form('Game already over!')
-        elif game.game_cancelled:
-            return game.to_form('This Game is cancelled')
-
-        if game.user_o == user.key:
-            letter = 'O'
-        else:
-            letter = 'X'
-
-        if user.key != game.next_move:
-            raise endpoints.BadRequestException('It\'s not your turn!')
-
-        if request.move > 8:
-            raise endpoints.BadRequestException('It\'s out or range. Your move should be in 0 to 8')
-
-        if isSpaceFree(game.board, request.move):
-            game.board[request.move] = letter
-            #game.moves.insert(request.move, letter)
-            game.history.append((letter, request.move))
-            game.next_move = game.user_x if (game.user_o == user.key) else game.user_o
-
-            if isWinner(game.board, letter):
-                game.end_game(user.key)
-                return game.to_form('You won the Game')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        user_key = User.get_key_by_name(request.user)
+        if not user_key:
+            raise endpoints.NotFoundException('User not found!')
+        try:
+            game, results = gamecache.play(game_key,
+                                           [(user_key, request.move)])
+        except datastore_errors.TransactionFailedError as e:
+            raise endpoints.ConflictException(
+                '{}, please try again'.format(e))
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        ok, message = results[0]
+        if not (ok or game.game_over or game.game_cancelled):
+            raise endpoints.BadRequestException(message)
+        game.publish_version()
+        return game.to_form(message)
+
+    @endpoints.method(request_message=GameMoveForms,
+                      response_message=MoveResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented
+    def make_moves(self, request):
+        """Makes moves in many games, or a sequence of moves in one game.
+        Moves are applied in order and each one gets its own result; an
+        invalid move is reported without stopping the rest of the batch.
+        Computer replies share MAX_BATCH_AI_TIME seconds; moves in computer
+        games past that are reported as not applied."""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most %d moves per batch' % MAX_BATCH_MOVES)
+        user_keys = dict((name, User.get_key_by_name(name))
+                         for name in set(form.user for form in request.moves))
+        results = [None] * len(request.moves)
+        by_game = collections.OrderedDict()  # game key -> [(index, user, move)]
+        for index, form in enumerate(request.moves):
+            try:
+                game_key = get_key_by_urlsafe(form.urlsafe_game_key, Game)
+            except endpoints.BadRequestException as e:
+                results[index] = (False, str(e))
+                continue
+            if not user_keys[form.user]:
+                results[index] = (False, 'User not found!')
+                continue
+            by_game.setdefault(game_key, []).append(
+                (index, user_keys[form.user], form.move))
+
+        played, failed = gamecache.play_multi(
+            dict((game_key, [move[1:] for move in moves])
+                 for game_key, moves in by_game.items()),
+            ai_deadline=time.time() + MAX_BATCH_AI_TIME)
+        games = []
+        for game_key, moves in by_game.items():
+            if game_key in failed:
+                outcomes = [(False, '{}, please try again'.format(
+                    failed[game_key]))] * len(moves)
             else:
-                if isBoardFull(game.board):
-                    game.end_game(False)
-                    return game.to_form('Game Tie')
-                else:
-                    game.put()
-                    return game.to_form('You have taken good position, let wait for the oponent')
-        else:
-            #return game.to_form('This is not a Free space to move')
-            raise endpoints.BadRequestException('This is not a Free space to move')
-
-    @endpoints.method(request_message=USER_REQUEST,
+                game, outcomes = played[game_key]
+                if game:
+                    games.append(game)
+            for (index, _, _), outcome in zip(moves, outcomes):
+                results[index] = outcome
+        Game.publish_versions(games)
+
+        return MoveResultForms(
+            results=[MoveResultForm(urlsafe_game_key=form.urlsafe_game_key,
+                                    move=form.move, ok=ok, message=message)
+                     for form, (ok, message) in zip(request.moves, results)],
+            games=Game.to_forms(games, 'Moves applied'))
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                   response_message=UserGameFroms,
                   path='user/games',
                   name='get_user_games',
                   http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Return all User's active games"""
-        user = User.get_user_by_name(request.user_name)
-        games = Game.query(ndb.OR(Game.user_x == user.key,
-                                  Game.user_o == user.key)). \
-            filter(Game.game_over == False).filter(Game.game_cancelled == False)
-
-        if not user:
+        """Return a page of the User's active games"""
+        user_key = User.get_key_by_name(request.user_name)
+        if not user_key:
             raise endpoints.BadRequestException('User not found!')
 
-        return UserGameFroms(games = [game.to_form('Active User Games') for game in games])
+        keys, next_cursor = fetch_page(
+            Game.query(Game.players == user_key,
+                       Game.status == GAME_ACTIVE),
+            request.page_size, request.cursor, keys_only=True)
+        # the cached copy of a game can be ahead of the index
+        games = [game for game in gamecache.get_multi(keys) if game and
+                 not (game.game_over or game.game_cancelled)]
+        return UserGameFroms(games=Game.to_forms(games, 'Active User Games'),
+                             next_cursor=next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameHistroy,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Return a Game's move history"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = gamecache.get(get_key_by_urlsafe(request.urlsafe_game_key, Game))
         if not game:
             raise endpoints.NotFoundException('Game not found')
         if not game.winner:
@@ -198,19 +343,24 @@ class TicTacToeApi(remote.Service):
         return GameHistroy(message=str(game.history),game_over= game.game_over,
                            game_cancelled= game.game_cancelled, tie = game.tie, winner=winner)
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores"""
+        scores, next_cursor = fetch_page(Score.query(), request.page_size,
+                                         request.cursor)
+        return ScoreForms(items=Score.to_forms(scores), next_cursor=next_cursor)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
         """Returns all of an individual User's scores"""
         user = User.get_user_by_name(request.user_name)
@@ -219,37 +369,104 @@ class TicTacToeApi(remote.Service):
                     'A User with that name does not exist!')
         scores = Score.query(ndb.OR(Score.user_x == user.key,
                                     Score.user_o == user.key))
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return ScoreForms(items=Score.to_forms(scores))
 
-    @endpoints.method(response_message=UserRankingForms,
+    @endpoints.method(request_message=HEAD_TO_HEAD_REQUEST,
+                      response_message=HeadToHeadForm,
+                      path='scores/user/{user_name}/versus/{opponent}',
+                      name='get_head_to_head',
+                      http_method='GET')
+    @instrumented
+    def get_head_to_head(self, request):
+        """Returns a User's record against one opponent"""
+        user_key = User.get_key_by_name(request.user_name)
+        opponent_key = User.get_key_by_name(request.opponent)
+        if not user_key or not opponent_key:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        if user_key == opponent_key:
+            raise endpoints.BadRequestException(
+                    'A User has no record against themselves')
+        key = HeadToHead.key_for(user_key, opponent_key)
+        record = key.get() or HeadToHead.new(key, user_key, opponent_key)
+        return record.to_form(user_key, {user_key: request.user_name,
+                                         opponent_key: request.opponent})
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserRankingForms,
                       path='scores/users',
                       name='get_user_rankings',
                       http_method='GET')
-
+    @instrumented
     def get_user_rankings(self, request):
-        """Return all users with Rankings"""
-        return UserRankingForms(users=[user.to_form() for user in User.query().order(-User.wins)])
+        """Return a page of users with Rankings, ordered by points"""
+        # Only the ranking fields are read, straight from the index
+        users, next_cursor = fetch_page(
+            User.query().order(-User.points), request.page_size,
+            request.cursor, projection=RANKING_PROJECTION)
+        histogram = leaderboard.get_histogram()
+        return UserRankingForms(
+            users=[user.to_form(leaderboard.rank_of(user.points, histogram))
+                   for user in users],
+            next_cursor=next_cursor)
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=UserRankingForms,
+                      path='leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+        """Return the top players, served from memcache"""
+        size = min(request.size or 10, leaderboard.TOP_SIZE)
+        histogram = leaderboard.get_histogram()
+        return UserRankingForms(
+            users=[user.to_form(leaderboard.rank_of(user.points, histogram))
+                   for user in leaderboard.top_users(size)])
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankingForm,
+                      path='leaderboard/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Return a User's rank and points"""
+        user = User.get_user_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        return user.to_form(leaderboard.rank_of(user.points))
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented
     def get_average_attempts(self, request):
         """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
-
-
-    @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+        return StringMessage(message='The average moves remaining is {:.2f}'.format(
+            stats.get_summary()['average_moves_remaining']))
+
+    @endpoints.method(response_message=GameStatsForm,
+                      path='games/stats',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+        """Get live statistics over all games"""
+        return GameStatsForm(**stats.get_summary())
+
+
+def _get_computer_key():
+    """Returns the key of the computer player, creating it on first use"""
+    key = User.get_key_by_name(ai.AI_USER_NAME)
+    if not key:
+        try:
+            key = User.create(ai.AI_USER_NAME).key
+        except ValueError:
+            key = User.get_key_by_name(ai.AI_USER_NAME)
+    return key
 
 
 api = endpoints.api_server([TicTacToeApi])
@@ -0,0 +1,45 @@
+"""archive.py - Moves ended games out of the Game kind.
+
+Finished and cancelled games that haven't changed for MAX_AGE_DAYS are
+copied into ArchivedGame (see models.py) and deleted from Game, a batch at
+a time, so the Game kind and its indexes only grow with the games still in
+play and the recently ended ones. Ended games never change again, so no
+transaction is needed: a batch that fails between the put and the delete
+is archived again by the next run. gamecache.get falls back to the archive,
+so get_game and get_game_history still find archived games."""
+
+import logging
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+from models import ArchivedGame
+from models import Game
+from models import GAME_CANCELLED
+from models import GAME_FINISHED
+
+MAX_AGE_DAYS = 30
+BATCH_SIZE = 200
+
+
+def archive_games(max_age_days=MAX_AGE_DAYS, batch_size=BATCH_SIZE):
+    """Archives one batch of games that ended more than max_age_days ago.
+    Returns True if the batch was full, so there may be more."""
+    cutoff = datetime.now() - timedelta(days=max_age_days)
+    keys = []
+    for status in (GAME_FINISHED, GAME_CANCELLED):
+        keys += Game.query(Game.status == status,
+                           Game.updated < cutoff).fetch(
+            batch_size - len(keys), keys_only=True)
+        if len(keys) >= batch_size:
+            break
+    # the query is eventually consistent: skip games already deleted
+    games = [game for game in ndb.get_multi(keys) if game and
+             (game.game_over or game.game_cancelled)]
+    ndb.put_multi([ArchivedGame.from_game(game) for game in games])
+    ndb.delete_multi([game.key for game in games])
+    logging.info('Archived %d games that ended before %s', len(games),
+                 cutoff)
+    # stop rather than chain on a batch of stale results
+    return len(keys) >= batch_size and bool(games)
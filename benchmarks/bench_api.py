@@ -0,0 +1,341 @@
+"""bench_api.py - Load test for every TicTacToeApi endpoint and the main.py
+handlers, run against the App Engine testbed datastore and memcache stubs.
+
+Seeds a population of users, games and scores, calls each endpoint many
+times and reports latency percentiles together with the number of
+datastore, memcache and task queue RPCs per call. Results are written as
+JSON so runs can be compared.
+
+    python benchmarks/bench_api.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        [--users 10000] [--games 100000] [--calls 200] [--output bench_api.json]"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def setup_sdk(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+class RpcCounter(object):
+    """Counts API calls per service and method through an apiproxy hook"""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    def __call__(self, service, call, request, response):
+        self.calls['{}.{}'.format(service, call)] += 1
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rpc_counter', self)
+
+    def reset(self):
+        counts = dict(self.calls)
+        self.calls.clear()
+        return counts
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        self.args = args
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        self.ndb = ndb
+        self.counter = RpcCounter()
+        self.counter.install()
+        self.results = collections.OrderedDict()
+        self.errors = 0
+
+    def seed(self):
+        from engine import other
+        from models import Game, Score, User, UserName
+        ndb = self.ndb
+        rng = random.Random(0)
+        start = time.time()
+        self.user_names = ['user{}'.format(i) for i in range(self.args.users)]
+        keys = []
+        for i in range(0, len(self.user_names), 500):
+            batch = [User(name=name, email='{}@example.com'.format(name),
+                          wins=rng.randint(0, 50), ties=rng.randint(0, 20),
+                          total_played=rng.randint(70, 100))
+                     for name in self.user_names[i:i + 500]]
+            for user in batch:
+                user.points = user.totlal_points
+            keys.extend(ndb.put_multi(batch))
+            ndb.put_multi([UserName(id=user.name, user=user.key)
+                           for user in batch])
+        self.user_keys = keys
+
+        self.active_games = []
+        for i in range(0, self.args.games, 500):
+            games, scores = [], []
+            for _ in range(min(500, self.args.games - i)):
+                user_x, user_o = rng.sample(keys, 2)
+                game = Game(user_x=user_x, user_o=user_o, next_move=user_x,
+                            board_size=3, win_length=3)
+                game._history = []
+                letter = 'X'
+                cells = list(range(9))
+                rng.shuffle(cells)
+                for cell in cells[:rng.randint(0, 9)]:
+                    if game.engine.is_over:
+                        break
+                    game.play(letter, cell)
+                    letter = other(letter)
+                game.next_move = user_x if letter == 'X' else user_o
+                if game.engine.is_over:
+                    game.game_over = True
+                    if game.engine.winner:
+                        game.winner = (user_x if game.engine.winner == 'X'
+                                       else user_o)
+                    else:
+                        game.tie = True
+                    scores.append(Score(
+                        user_x=user_x, user_o=user_o, date=_today(),
+                        result=('tie' if game.tie else 'user_x'
+                                if game.winner == user_x else 'user_o')))
+                game._pending_stats = None
+                games.append(game)
+            ndb.put_multi(games + scores)
+            self.active_games.extend(game for game in games
+                                     if not game.game_over)
+        ndb.get_context().clear_cache()
+        print('seeded {} users and {} games in {:.1f}s'.format(
+            self.args.users, self.args.games, time.time() - start))
+
+    def measure(self, name, call, prepare=None, calls=None):
+        """Runs call() calls times (args.calls by default), recording
+        latency and RPCs. The result of prepare(), if given, is passed to
+        call and not measured. A call that raises, or a handler response
+        with an error status, is logged and counted as an error and left
+        out of the latencies and RPCs."""
+        calls = calls or self.args.calls
+        latencies = []
+        rpcs = collections.Counter()
+        errors = 0
+        for _ in range(calls):
+            args = (prepare(),) if prepare else ()
+            self.ndb.get_context().clear_cache()
+            self.counter.reset()
+            start = time.time()
+            try:
+                response = call(*args)
+            except Exception:
+                logging.exception('%s failed', name)
+                errors += 1
+                continue
+            elapsed = (time.time() - start) * 1000
+            if getattr(response, 'status_int', 200) >= 400:
+                logging.error('%s returned %s: %s', name, response.status,
+                              response.body[:2000])
+                errors += 1
+                continue
+            latencies.append(elapsed)
+            rpcs.update(self.counter.reset())
+        self.errors += errors
+        self.results[name] = {'calls': calls, 'errors': errors}
+        if not latencies:
+            print('{:28s} every call failed'.format(name))
+            return
+        ok = float(len(latencies))
+        self.results[name].update({
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p90': percentile(latencies, 0.9),
+                'p99': percentile(latencies, 0.99),
+                'mean': sum(latencies) / ok,
+            },
+            'rpcs_per_call': dict((rpc, count / ok)
+                                  for rpc, count in sorted(rpcs.items())),
+        })
+        print('{:28s} p50 {:7.2f}ms  p99 {:7.2f}ms  rpcs/call {:6.1f}{}'.format(
+            name, self.results[name]['latency_ms']['p50'],
+            self.results[name]['latency_ms']['p99'],
+            sum(rpcs.values()) / ok,
+            '  ({} errors)'.format(errors) if errors else ''))
+
+    def run(self):
+        from protorpc import message_types
+        import api
+        import gamecache
+        import main
+        from models import GameMoveForm, GameMoveForms
+        service = api.TicTacToeApi()
+        rng = random.Random(1)
+
+        def request(container, **fields):
+            return container.combined_message_class(**fields)
+
+        def random_user():
+            return rng.choice(self.user_names)
+
+        def random_game():
+            return rng.choice(self.active_games).key.urlsafe()
+
+        counter = iter(range(10 ** 9))
+
+        def next_move():
+            while True:
+                game = gamecache.get(rng.choice(self.active_games).key)
+                if not (game.game_over or game.game_cancelled):
+                    return request(api.MAKE_MOVE_REQUEST,
+                                   urlsafe_game_key=game.key.urlsafe(),
+                                   user=game.next_move.get().name,
+                                   move=rng.choice(list(game.engine.free_cells())))
+
+        self.measure('create_user', lambda: service.create_user(request(
+            api.USER_REQUEST, user_name='bench{}'.format(next(counter)))))
+        self.measure('new_game', lambda: service.new_game(request(
+            api.NEW_GAME_REQUEST, user_x=random_user(), user_o=random_user())))
+        self.measure('new_game_vs_computer', lambda: service.new_game(request(
+            api.NEW_GAME_REQUEST, user_x=random_user(), vs_computer=True)))
+        self.measure('get_game', lambda: service.get_game(request(
+            api.GET_GAME_REQUEST, urlsafe_game_key=random_game())))
+        self.measure('poll_game_unchanged', lambda: service.poll_game(request(
+            api.POLL_GAME_REQUEST, urlsafe_game_key=random_game(),
+            version=10 ** 6)))
+        self.measure('make_move', service.make_move, prepare=next_move)
+
+        def next_moves():
+            moves = []
+            for _ in range(20):
+                move = next_move()
+                moves.append(GameMoveForm(
+                    urlsafe_game_key=move.urlsafe_game_key, user=move.user,
+                    move=move.move))
+            return GameMoveForms(moves=moves)
+
+        self.measure('make_moves (20 games)', service.make_moves,
+                     prepare=next_moves)
+        self.measure('get_hint', lambda: service.get_hint(request(
+            api.GET_GAME_REQUEST, urlsafe_game_key=random_game())))
+        self.measure('get_game_history', lambda: service.get_game_history(
+            request(api.GET_GAME_REQUEST, urlsafe_game_key=random_game())))
+        self.measure('get_user_games', lambda: service.get_user_games(request(
+            api.USER_PAGE_REQUEST, user_name=random_user())))
+        self.measure('get_scores', lambda: service.get_scores(request(
+            api.PAGE_REQUEST, page_size=100)))
+        self.measure('get_user_scores', lambda: service.get_user_scores(
+            request(api.USER_REQUEST, user_name=random_user())))
+        self.measure('get_head_to_head', lambda: service.get_head_to_head(
+            request(api.HEAD_TO_HEAD_REQUEST, user_name=random_user(),
+                    opponent=random_user())))
+        self.measure('get_user_rankings', lambda: service.get_user_rankings(
+            request(api.PAGE_REQUEST, page_size=100)))
+        self.measure('get_leaderboard', lambda: service.get_leaderboard(
+            request(api.LEADERBOARD_REQUEST, size=10)))
+        self.measure('get_user_rank', lambda: service.get_user_rank(request(
+            api.USER_REQUEST, user_name=random_user())))
+        self.measure('get_average_attempts_remaining',
+                     lambda: service.get_average_attempts(
+                         message_types.VoidMessage()))
+        self.measure('get_game_stats', lambda: service.get_game_stats(
+            message_types.VoidMessage()))
+        self.measure('cancel_game', lambda: service.cancel_game(request(
+            api.GET_GAME_REQUEST, urlsafe_game_key=random_game())))
+
+        # cron and task handlers, fewer calls: most of them handle a batch
+        calls = max(1, self.args.calls // 20)
+
+        def handler(name, path, **params):
+            self.measure(name, lambda: main.app.get_response(path, **params),
+                         calls=calls)
+
+        def run_params(reminder, **params):
+            params.update(reminder=reminder,
+                          run_id='bench-{}'.format(next(counter)))
+            return params
+
+        recipients = json.dumps([('{}@example.com'.format(name), name)
+                                 for name in self.user_names[:50]])
+        handler('cron flush_games', '/crons/flush_games')
+        handler('cron send_reminder', '/crons/send_reminder')
+        handler('cron send_cancel_reminder', '/crons/send_cancel_reminder')
+        self.measure('task reminders/page', lambda: main.app.get_response(
+            '/tasks/reminders/page', POST=run_params('active', page='0')),
+            calls=calls)
+        self.measure('task reminders/send (50)', lambda: main.app.get_response(
+            '/tasks/reminders/send', POST=run_params(
+                'active', recipients=recipients)), calls=calls)
+        handler('task cache_average_attempts', '/tasks/cache_average_attempts',
+                POST={})
+        handler('task migrate_game_encoding', '/tasks/migrate_game_encoding',
+                POST={})
+        handler('task backfill_game_index', '/tasks/backfill_game_index',
+                POST={})
+        handler('task seed_game_stats', '/tasks/seed_game_stats', POST={})
+        handler('admin stats', '/admin/stats')
+        # rewrites every user
+        self.measure('task rebuild_leaderboard', lambda: main.app.get_response(
+            '/tasks/rebuild_leaderboard', POST={}), calls=1)
+        # last, it moves the finished games out of the Game kind
+        handler('cron archive_games', '/crons/archive_games?max_age_days=0')
+
+    def write(self):
+        with open(self.args.output, 'w') as out:
+            json.dump({'users': self.args.users, 'games': self.args.games,
+                       'endpoints': self.results}, out, indent=2,
+                      sort_keys=True)
+        print('results written to {}'.format(self.args.output))
+        self.testbed.deactivate()
+
+
+def _today():
+    from datetime import date
+    return date.today()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the google_appengine SDK directory')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--calls', type=int, default=200,
+                        help='calls per endpoint')
+    parser.add_argument('--output', default='bench_api.json')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+    setup_sdk(args.sdk)
+    bench = Bench(args)
+    bench.seed()
+    bench.run()
+    bench.write()
+    if bench.errors:
+        sys.exit('{} calls failed, see the log above'.format(bench.errors))
+
+
+if __name__ == '__main__':
+    main()
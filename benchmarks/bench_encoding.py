@@ -0,0 +1,81 @@
+"""bench_encoding.py - Compares the size and (de)serialization time of the
+old pickled board/history with the packed encoding in codec.py.
+
+Runs without the App Engine SDK. Use Python 2.7 to match the runtime.
+    python benchmarks/bench_encoding.py [--games N]"""
+
+import argparse
+import os
+import pickle
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import codec
+from engine import Board
+from engine import other
+
+# ndb.PickleProperty uses pickle.dumps(value, 2)
+PICKLE_PROTOCOL = 2
+
+
+def random_game(size, win_length=None):
+    board = Board(size, win_length)
+    history = []
+    letter = 'X'
+    cells = list(range(board.cells))
+    random.shuffle(cells)
+    for cell in cells:
+        history.append((letter, cell))
+        if board.play(cell, letter) or board.is_full:
+            break
+        letter = other(letter)
+    return board, history
+
+
+def bench(size, games):
+    samples = [random_game(size) for _ in range(games)]
+    legacy = [(board.to_cells(), history) for board, history in samples]
+
+    pickled = [(pickle.dumps(cells, PICKLE_PROTOCOL),
+                pickle.dumps(history, PICKLE_PROTOCOL))
+               for cells, history in legacy]
+    packed = [(codec.encode_board(board), codec.encode_history(history))
+              for board, history in samples]
+
+    # Both paths end with the engine.Board that Game.engine builds
+    def pickle_round_trip():
+        for cells, history in legacy:
+            Board.from_cells(pickle.loads(pickle.dumps(cells, PICKLE_PROTOCOL)),
+                             size)
+            pickle.loads(pickle.dumps(history, PICKLE_PROTOCOL))
+
+    def packed_round_trip():
+        for board, history in samples:
+            codec.decode_board(codec.encode_board(board), size)
+            codec.decode_history(codec.encode_history(history))
+
+    pickle_time = min(timeit.repeat(pickle_round_trip, number=1, repeat=3))
+    packed_time = min(timeit.repeat(packed_round_trip, number=1, repeat=3))
+    pickle_bytes = sum(len(b) + len(h) for b, h in pickled) / float(games)
+    packed_bytes = sum(len(b) + len(h) for b, h in packed) / float(games)
+    print('{0}x{0}: {1:8.1f} -> {2:6.1f} bytes/game, '
+          'round trip {3:7.1f} -> {4:7.1f} us/game'.format(
+              size, pickle_bytes, packed_bytes,
+              pickle_time / games * 1e6, packed_time / games * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--games', type=int, default=2000)
+    args = parser.parse_args()
+    random.seed(0)
+    print('pickled board+history -> packed board+history')
+    for size in (3, 4, 8, 15):
+        bench(size, args.games)
+
+
+if __name__ == '__main__':
+    main()
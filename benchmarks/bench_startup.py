@@ -0,0 +1,157 @@
+"""bench_startup.py - Time to first response of a new instance, with and
+without the /_ah/warmup request (warmup.py).
+
+Every sample runs in a fresh Python process, like a new instance: it starts
+the testbed stubs on a datastore seeded once by this script, then serves
+the first requests a user would send. Without warmup the first request pays
+for importing the API and filling the caches; with warmup that is done by
+warmup.warm_up() before the clock for the first response starts. Memcache
+starts empty in every process, as after a memcache flush. Results are
+written as JSON so runs can be compared.
+
+    python benchmarks/bench_startup.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        [--users 2000] [--runs 10] [--output bench_startup.json]"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+MODES = ('cold', 'warmup')
+
+
+def setup_sdk(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def activate(datastore_file, save_changes=False):
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(datastore_file=datastore_file,
+                               save_changes=save_changes,
+                               consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    return bed
+
+
+def seed(args):
+    """Writes users and one active game to the datastore file. Returns
+    what the samples need to build their requests."""
+    bed = activate(args.datastore, save_changes=True)
+    from google.appengine.ext import ndb
+    from models import Game, User, UserName
+    names = ['user{}'.format(i) for i in range(args.users)]
+    for i in range(0, len(names), 500):
+        users = [User(name=name, wins=i % 50, ties=i % 7,
+                      total_played=100) for name in names[i:i + 500]]
+        for user in users:
+            user.points = user.totlal_points
+        ndb.put_multi(users)
+        ndb.put_multi([UserName(id=user.name, user=user.key)
+                       for user in users])
+    user_x, user_o = User.get_key_by_name(names[0]), User.get_key_by_name(
+        names[1])
+    game = Game.new_game(user_x, user_o)
+    bed.deactivate()
+    return {'user_name': names[-1], 'game': game.key.urlsafe()}
+
+
+def sample(args, mode, seeded):
+    """One new instance: returns its timings in milliseconds"""
+    activate(args.datastore)
+    timings = {}
+    start = time.time()
+    if mode == 'warmup':
+        import warmup
+        warmup.warm_up()
+        timings['warmup'] = (time.time() - start) * 1000
+    # the clock of the first user request starts here
+    first = time.time()
+    import api
+    service = api.TicTacToeApi()
+
+    def request(container, **fields):
+        return container.combined_message_class(**fields)
+
+    calls = [
+        ('get_leaderboard', lambda: service.get_leaderboard(request(
+            api.LEADERBOARD_REQUEST, size=10))),
+        ('get_user_rank', lambda: service.get_user_rank(request(
+            api.USER_REQUEST, user_name=seeded['user_name']))),
+        ('get_hint', lambda: service.get_hint(request(
+            api.GET_GAME_REQUEST, urlsafe_game_key=seeded['game']))),
+    ]
+    for name, call in calls:
+        call_start = time.time()
+        call()
+        timings[name] = (time.time() - call_start) * 1000
+        if 'first_response' not in timings:
+            timings['first_response'] = (time.time() - first) * 1000
+    return timings
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the google_appengine SDK directory')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=10,
+                        help='new instances per mode')
+    parser.add_argument('--output', default='bench_startup.json')
+    # internal: run one sample and print its timings
+    parser.add_argument('--sample', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--datastore', help=argparse.SUPPRESS)
+    parser.add_argument('--seeded', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+    setup_sdk(args.sdk)
+
+    if args.sample:
+        print(json.dumps(sample(args, args.sample, json.loads(args.seeded))))
+        return
+
+    args.datastore = os.path.join(tempfile.mkdtemp(), 'bench.datastore')
+    seeded = json.dumps(seed(args))
+    results = {}
+    for mode in MODES:
+        samples = []
+        for _ in range(args.runs):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--sdk', args.sdk,
+                 '--sample', mode, '--datastore', args.datastore,
+                 '--seeded', seeded])
+            samples.append(json.loads(output.splitlines()[-1]))
+        results[mode] = dict((name, median([timings[name]
+                                             for timings in samples]))
+                             for name in samples[0])
+        print('{:8s} first response {:7.1f}ms  ({})'.format(
+            mode, results[mode]['first_response'], ', '.join(
+                '{} {:.1f}ms'.format(name, ms) for name, ms
+                in sorted(results[mode].items())
+                if name != 'first_response')))
+    with open(args.output, 'w') as out:
+        json.dump({'users': args.users, 'runs': args.runs,
+                   'median_ms': results}, out, indent=2, sort_keys=True)
+    print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+"""bulk.py - Streaming export and import of Users, Games (hot and
+archived) and Scores.
+
+Runs outside App Engine against a deployed app (or the dev server) through
+remote_api. Each kind is read with query cursors in large batches and
+written to gzipped NDJSON or CSV chunk files, one batch in memory at a
+time. The cursor after every finished chunk is saved next to the files, so
+an interrupted export picks up where it stopped. Import streams the chunk
+files back and writes them with put_multi, recording finished files so it
+can be resumed too.
+
+    python bulk.py export HOST [--out export] [--format ndjson|csv]
+        [--kinds User,Game,ArchivedGame,Score] [--batch-size 1000]
+        [--chunk-size 100000]
+    python bulk.py import HOST [--dir export]
+        [--kinds User,Game,ArchivedGame,Score] [--batch-size 500]
+
+Pass --sdk path/to/google_appengine if the SDK isn't on the path. Game,
+ArchivedGame (same records as Game) and Score files can be fed straight to
+analysis.py:
+
+    python analysis.py export/*Game-*.ndjson.gz --scores export/Score-*.ndjson.gz
+
+After an import, run /tasks/rebuild_leaderboard to rebuild the rank
+buckets. Game statistics counters are not rebuilt by an import. Games keep
+the time they were last updated (for archived games, when they ended), so
+an import doesn't restart their archive clock."""
+
+import argparse
+import csv
+import glob
+import gzip
+import json
+import logging
+import os
+import sys
+
+from rating import INITIAL_RATING
+
+KINDS = ('User', 'Game', 'ArchivedGame', 'Score')  # games refer to users
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 500
+CHUNK_SIZE = 100000  # entities per file
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')  # isoformat()
+EXTENSIONS = {'ndjson': '.ndjson.gz', 'csv': '.csv.gz'}
+
+# Fields of each record in file order, with their type for CSV files. User
+# references are stored as the User's id, so an export can be imported into
+# another app.
+SCHEMAS = {
+    'User': [('id', 'id'), ('name', 'str'), ('email', 'str'),
+             ('wins', 'int'), ('ties', 'int'), ('total_played', 'int'),
+             ('points', 'int'), ('rating', 'float')],
+    'Game': [('id', 'id'), ('user_x', 'id'), ('user_o', 'id'),
+             ('next_move', 'id'), ('winner', 'id'), ('computer', 'id'),
+             ('board_size', 'int'), ('win_length', 'int'),
+             ('history', 'cells'), ('game_over', 'bool'),
+             ('game_cancelled', 'bool'), ('tie', 'bool'), ('version', 'int'),
+             ('updated', 'str')],
+    'Score': [('id', 'id'), ('user_x', 'id'), ('user_o', 'id'),
+              ('result', 'str'), ('date', 'str')],
+}
+SCHEMAS['ArchivedGame'] = SCHEMAS['Game']
+
+
+def connect(host, sdk=None):
+    """Points the App Engine APIs at a deployed app through remote_api"""
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(
+        host, '/_ah/remote_api', secure=not host.startswith('localhost'))
+
+
+def _id(key):
+    return key.id() if key else None
+
+
+def _parse_time(value):
+    from datetime import datetime
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError('Unknown time format: {}'.format(value))
+
+
+def to_record(kind, entity):
+    """Returns the export record (a dict) of an entity"""
+    if kind == 'User':
+        return {'id': entity.key.id(), 'name': entity.name,
+                'email': entity.email, 'wins': entity.wins,
+                'ties': entity.ties, 'total_played': entity.total_played,
+                'points': entity.totlal_points, 'rating': entity.rating}
+    elif kind == 'ArchivedGame':
+        return to_record('Game', entity.to_game())
+    elif kind == 'Game':
+        return {'id': entity.key.id(), 'user_x': _id(entity.user_x),
+                'user_o': _id(entity.user_o),
+                'next_move': _id(entity.next_move),
+                'winner': _id(entity.winner),
+                'computer': _id(entity.computer),
+                'board_size': entity.board_size,
+                'win_length': entity.engine.win_length,
+                'history': [cell for _, cell in entity.history],
+                'game_over': entity.game_over,
+                'game_cancelled': entity.game_cancelled,
+                'tie': entity.tie, 'version': entity.version,
+                'updated': (entity.updated.isoformat() if entity.updated
+                            else None)}
+    return {'id': entity.key.id(), 'user_x': _id(entity.user_x),
+            'user_o': _id(entity.user_o), 'result': entity.result,
+            'date': entity.date.isoformat()}
+
+
+def from_record(kind, record):
+    """Returns the entity of an export record"""
+    from datetime import datetime
+    from google.appengine.ext import ndb
+    from engine import Board
+    from engine import O
+    from engine import X
+    import models
+
+    def user(field):
+        value = record.get(field)
+        return ndb.Key(models.User, value) if value is not None else None
+
+    if kind == 'User':
+        return models.User(id=record['id'], name=record['name'],
+                           email=record.get('email'),
+                           wins=record['wins'], ties=record['ties'],
+                           total_played=record['total_played'],
+                           points=record['points'],
+                           rating=record.get('rating', INITIAL_RATING))
+    elif kind == 'ArchivedGame':
+        return models.ArchivedGame.from_game(from_record('Game', record))
+    elif kind == 'Game':
+        game = models.Game(id=record['id'], user_x=user('user_x'),
+                           user_o=user('user_o'),
+                           next_move=user('next_move'), winner=user('winner'),
+                           computer=user('computer'),
+                           board_size=record['board_size'],
+                           win_length=record['win_length'],
+                           game_over=record['game_over'],
+                           game_cancelled=record['game_cancelled'],
+                           tie=record['tie'], version=record['version'])
+        # exports from before updated was exported count from the import
+        game.updated = (_parse_time(record['updated'])
+                        if record.get('updated') else datetime.utcnow())
+        game._keep_updated = True  # or the put would stamp the import time
+        # _pre_put_hook packs the board and history
+        game._history = [(X if i % 2 == 0 else O, cell)
+                         for i, cell in enumerate(record['history'])]
+        game._engine = Board(record['board_size'], record['win_length'])
+        for letter, cell in game._history:
+            game._engine._place(cell, letter)
+        return game
+    return models.Score(id=record['id'], user_x=user('user_x'),
+                        user_o=user('user_o'), result=record['result'],
+                        date=datetime.strptime(record['date'],
+                                               '%Y-%m-%d').date())
+
+
+def _to_csv(value, kind):
+    if value is None:
+        return ''
+    elif kind == 'cells':
+        return ' '.join(str(cell) for cell in value)
+    elif kind == 'bool':
+        return '1' if value else '0'
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _from_csv(value, kind):
+    if value == '' and kind != 'cells':
+        return None
+    elif kind == 'cells':
+        return [int(cell) for cell in value.split()]
+    elif kind == 'bool':
+        return value == '1'
+    elif kind == 'int' or (kind == 'id' and value.isdigit()):
+        return int(value)
+    elif kind == 'float':
+        return float(value)
+    return value.decode('utf-8')
+
+
+def write_records(path, kind, records, file_format):
+    """Writes records to a gzipped chunk file. Returns how many."""
+    fields = SCHEMAS[kind]
+    count = 0
+    with gzip.open(path, 'wb') as out:
+        if file_format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow([name for name, _ in fields])
+            for record in records:
+                writer.writerow([_to_csv(record.get(name), field_type)
+                                 for name, field_type in fields])
+                count += 1
+        else:
+            for record in records:
+                out.write(json.dumps(record, sort_keys=True) + '\n')
+                count += 1
+    return count
+
+
+def read_records(path, kind):
+    """Yields the records of a chunk file, one line at a time"""
+    types = dict(SCHEMAS[kind])
+    with gzip.open(path, 'rb') as lines:
+        if path.endswith(EXTENSIONS['csv']):
+            reader = csv.reader(lines)
+            header = next(reader)
+            for row in reader:
+                yield dict((name, _from_csv(value, types[name]))
+                           for name, value in zip(header, row))
+        else:
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_batches(query, cursor=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yields (entities, next_cursor) for every batch of a query, starting
+    at cursor (a urlsafe string). next_cursor is None after the last."""
+    from google.appengine.datastore.datastore_query import Cursor
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while True:
+        entities, next_cursor, more = query.fetch_page(
+            batch_size, start_cursor=start)
+        more = more and next_cursor
+        yield entities, next_cursor.urlsafe() if more else None
+        if not more:
+            return
+        start = next_cursor
+
+
+class ExportState(object):
+    """Progress of the export of one kind, saved after every chunk"""
+
+    def __init__(self, path):
+        self.path = path
+        self.chunk, self.cursor, self.exported, self.done = 0, None, 0, False
+        if os.path.exists(path):
+            with open(path) as state:
+                self.__dict__.update(json.load(state))
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as state:
+            json.dump({'chunk': self.chunk, 'cursor': self.cursor,
+                       'exported': self.exported, 'done': self.done}, state)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def export_kind(kind, out_dir, file_format='ndjson',
+                batch_size=EXPORT_BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """Exports every entity of a kind to chunk files, resuming a previous
+    export of the same directory. Returns the number of entities."""
+    import models
+    state = ExportState(os.path.join(out_dir, kind + '.state.json'))
+    if state.done:
+        logging.info('%s already exported (%d entities)', kind,
+                     state.exported)
+        return state.exported
+    batches = iter_batches(getattr(models, kind).query(), state.cursor,
+                           batch_size)
+    while not state.done:
+        progress = {}
+
+        def chunk():
+            # one chunk worth of records; the cursor after its last batch
+            # is where the next chunk starts
+            count = 0
+            for entities, cursor in batches:
+                for entity in entities:
+                    yield to_record(kind, entity)
+                count += len(entities)
+                progress['cursor'] = cursor
+                if cursor is None or count >= chunk_size:
+                    return
+
+        path = os.path.join(out_dir, '{}-{:05d}{}'.format(
+            kind, state.chunk, EXTENSIONS[file_format]))
+        # an interrupted chunk is written again from the saved cursor
+        count = write_records(path + '.tmp', kind, chunk(), file_format)
+        os.rename(path + '.tmp', path)
+        state.chunk += 1
+        state.exported += count
+        state.cursor = progress.get('cursor')
+        state.done = state.cursor is None
+        state.save()
+        logging.info('%s: %d exported', kind, state.exported)
+    return state.exported
+
+
+def import_kind(kind, in_dir, batch_size=IMPORT_BATCH_SIZE):
+    """Imports the chunk files of a kind with put_multi batches, skipping
+    files a previous run finished. Returns the number of entities."""
+    from google.appengine.ext import ndb
+    import models
+    done_path = os.path.join(in_dir, kind + '.imported.json')
+    finished = []
+    if os.path.exists(done_path):
+        with open(done_path) as done:
+            finished = json.load(done)
+    paths = sorted(path for extension in EXTENSIONS.values()
+                   for path in glob.glob(os.path.join(
+                       in_dir, '{}-*{}'.format(kind, extension))))
+    imported = 0
+    max_id = 0
+    for path in paths:
+        name = os.path.basename(path)
+        if name in finished:
+            continue
+        batch = []
+        for record in read_records(path, kind):
+            entity = from_record(kind, record)
+            batch.append(entity)
+            if kind == 'User':
+                batch.append(models.UserName(id=entity.name, user=entity.key))
+            if isinstance(record['id'], (int, long)):
+                max_id = max(max_id, record['id'])
+            imported += 1
+            if len(batch) >= batch_size:
+                ndb.put_multi(batch)
+                batch = []
+        if batch:
+            ndb.put_multi(batch)
+        finished.append(name)
+        with open(done_path, 'w') as done:
+            json.dump(finished, done)
+        logging.info('%s: imported %s', kind, name)
+    if max_id:
+        # keep new entities from being given an imported id; archived games
+        # keep the id of their Game
+        model = models.Game if kind == 'ArchivedGame' else getattr(models,
+                                                                    kind)
+        model.allocate_ids(max=max_id)
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Streaming export and import of Users, Games and Scores')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('host', help='app host, e.g. my-app.appspot.com')
+    parser.add_argument('--sdk', help='path to the google_appengine SDK')
+    parser.add_argument('--kinds', default=','.join(KINDS))
+    parser.add_argument('--out', '--dir', dest='dir', default='export')
+    parser.add_argument('--format', choices=sorted(EXTENSIONS),
+                        default='ndjson')
+    parser.add_argument('--batch-size', type=int,
+                        help='entities per query batch or put_multi')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='entities per exported file')
+    args = parser.parse_args()
+    kinds = [kind for kind in KINDS if kind in args.kinds.split(',')]
+
+    logging.basicConfig(level=logging.INFO)
+    connect(args.host, args.sdk)
+    if args.command == 'export':
+        if not os.path.isdir(args.dir):
+            os.makedirs(args.dir)
+        for kind in kinds:
+            export_kind(kind, args.dir, args.format,
+                        args.batch_size or EXPORT_BATCH_SIZE, args.chunk_size)
+    else:
+        for kind in kinds:
+            import_kind(kind, args.dir, args.batch_size or IMPORT_BATCH_SIZE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""codec.py - Compact binary encoding of boards and move histories.
+
+A board is packed at 2 bits per cell (0 empty, 1 X, 2 O), four cells per
+byte, so a 3x3 board takes 3 bytes and a 15x15 board 57. A history is one
+byte per move holding the cell index; X always moves first and players
+alternate, so the letter of move i is implied by its parity."""
+
+from engine import Board
+from engine import O
+from engine import X
+
+_CODES = {X: 1, O: 2}
+
+
+def encode_board(board):
+    """Packs an engine.Board into a byte string"""
+    data = bytearray((board.cells + 3) // 4)
+    for letter, code in _CODES.items():
+        bits = board.stones[letter]
+        while bits:
+            low = bits & -bits
+            cell = low.bit_length() - 1
+            data[cell >> 2] |= code << ((cell & 3) << 1)
+            bits ^= low
+    return bytes(data)
+
+
+def decode_board(data, size, win_length=None):
+    """Unpacks a byte string produced by encode_board into an engine.Board"""
+    board = Board(size, win_length)
+    for index, byte in enumerate(bytearray(data)):
+        if not byte:
+            continue
+        for offset in range(4):
+            code = byte >> (offset << 1) & 3
+            if code:
+                board._place(index * 4 + offset, X if code == 1 else O)
+    return board
+
+
+def encode_history(history):
+    """Packs a list of (letter, cell) moves, one byte per move"""
+    return bytes(bytearray(cell for _, cell in history))
+
+
+def decode_history(data):
+    """Unpacks a byte string produced by encode_history into a list of
+    (letter, cell) tuples"""
+    return [(X if i % 2 == 0 else O, cell)
+            for i, cell in enumerate(bytearray(data))]
@@ -0,0 +1,183 @@
+"""engine.py - Bitboard game engine for NxN, k-in-a-row boards.
+
+Each player's stones are kept as a single integer bitboard (bit ``i`` is
+cell ``i``, row-major). For every row, column and diagonal the engine also
+keeps a per-player stone counter which is updated on each move, so a move
+only ever looks at the four lines running through the cell that was just
+played. Win and full-board checks therefore cost O(1) in the board area;
+when the win length is shorter than a line a short run scan of at most
+``2 * (k - 1)`` cells confirms the win."""
+
+X = 'X'
+O = 'O'
+EMPTY = ''
+
+MIN_BOARD_SIZE = 3
+MAX_BOARD_SIZE = 15
+
+# (row step, column step) for rows, columns, diagonals and anti-diagonals
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def default_win_length(board_size):
+    """Classic rules up to 5x5, five-in-a-row (gomoku) on larger boards"""
+    return min(board_size, 5)
+
+
+def other(letter):
+    """Returns the opponent's letter"""
+    return O if letter == X else X
+
+
+class Board(object):
+    """Incremental NxN board with k-in-a-row win detection"""
+
+    def __init__(self, size=3, win_length=None):
+        if not MIN_BOARD_SIZE <= size <= MAX_BOARD_SIZE:
+            raise ValueError('Board size must be between {} and {}'.format(
+                MIN_BOARD_SIZE, MAX_BOARD_SIZE))
+        win_length = win_length or default_win_length(size)
+        if not 1 < win_length <= size:
+            raise ValueError('Win length must be between 2 and {}'.format(
+                size))
+        self.size = size
+        self.win_length = win_length
+        self.cells = size * size
+        self.stones = {X: 0, O: 0}
+        self.moves = 0
+        self.winner = None
+        # rows, columns, diagonals (c - r) and anti-diagonals (r + c)
+        n_lines = 6 * size - 2
+        self._counts = {X: [0] * n_lines, O: [0] * n_lines}
+
+    @classmethod
+    def from_cells(cls, cells, size=None, win_length=None):
+        """Builds a board from the legacy list-of-letters representation"""
+        size = size or int(round(len(cells) ** 0.5))
+        board = cls(size, win_length)
+        for cell, letter in enumerate(cells):
+            if letter:
+                board._place(cell, letter)
+        return board
+
+    @classmethod
+    def from_history(cls, history, size=3, win_length=None):
+        """Replays a list of (letter, cell) moves on an empty board"""
+        board = cls(size, win_length)
+        for letter, cell in history:
+            board.play(cell, letter)
+        return board
+
+    def copy(self):
+        """Returns an independent copy of the board"""
+        board = Board.__new__(Board)
+        board.__dict__.update(self.__dict__)
+        board.stones = dict(self.stones)
+        board._counts = {X: list(self._counts[X]), O: list(self._counts[O])}
+        return board
+
+    @property
+    def occupied(self):
+        return self.stones[X] | self.stones[O]
+
+    @property
+    def is_full(self):
+        return self.moves == self.cells
+
+    @property
+    def is_over(self):
+        return self.winner is not None or self.is_full
+
+    def is_free(self, cell):
+        """Returns True if the cell is on the board and not taken"""
+        return 0 <= cell < self.cells and not self.occupied >> cell & 1
+
+    def get(self, cell):
+        """Returns the letter on a cell, or EMPTY"""
+        if self.stones[X] >> cell & 1:
+            return X
+        if self.stones[O] >> cell & 1:
+            return O
+        return EMPTY
+
+    def to_cells(self):
+        """Returns the legacy list-of-letters representation"""
+        return [self.get(cell) for cell in range(self.cells)]
+
+    def free_cells(self):
+        """Yields every free cell index"""
+        occupied = self.occupied
+        for cell in range(self.cells):
+            if not occupied >> cell & 1:
+                yield cell
+
+    def _line_indexes(self, row, col):
+        n = self.size
+        return (row,
+                n + col,
+                2 * n + (col - row + n - 1),
+                4 * n - 1 + (row + col))
+
+    def _line_length(self, direction, row, col):
+        n = self.size
+        if direction < 2:
+            return n
+        if direction == 2:
+            return n - abs(col - row)
+        return n - abs(row + col - (n - 1))
+
+    def _run_length(self, bits, row, col, d_row, d_col):
+        """Counts the contiguous stones through (row, col) along a line"""
+        n = self.size
+        limit = self.win_length - 1
+        run = 1
+        for sign in (1, -1):
+            r, c = row + sign * d_row, col + sign * d_col
+            steps = 0
+            while (steps < limit and 0 <= r < n and 0 <= c < n and
+                   bits >> (r * n + c) & 1):
+                run += 1
+                steps += 1
+                r += sign * d_row
+                c += sign * d_col
+        return run
+
+    def play(self, cell, letter):
+        """Places a stone. Returns True if the move wins the game.
+        Raises ValueError on an illegal move."""
+        if self.winner is not None:
+            raise ValueError('Game already over')
+        if not self.is_free(cell):
+            raise ValueError('Cell {} is not free'.format(cell))
+        return self._place(cell, letter)
+
+    def _place(self, cell, letter):
+        row, col = divmod(cell, self.size)
+        bits = self.stones[letter] | (1 << cell)
+        self.stones[letter] = bits
+        self.moves += 1
+        counts = self._counts[letter]
+        won = False
+        for direction, index in enumerate(self._line_indexes(row, col)):
+            counts[index] += 1
+            if won or counts[index] < self.win_length:
+                continue
+            if counts[index] == self._line_length(direction, row, col):
+                won = True
+            else:
+                d_row, d_col = DIRECTIONS[direction]
+                won = self._run_length(bits, row, col, d_row,
+                                       d_col) >= self.win_length
+        if won and self.winner is None:
+            self.winner = letter
+        return won
+
+    def undo(self, cell, letter):
+        """Removes a stone placed by play(). Used by the search code."""
+        row, col = divmod(cell, self.size)
+        self.stones[letter] &= ~(1 << cell)
+        self.moves -= 1
+        self.winner = None
+        counts = self._counts[letter]
+        for index in self._line_indexes(row, col):
+            counts[index] -= 1
@@ -0,0 +1,525 @@
+"""gamecache.py - Write-behind cache of active games.
+
+An active game lives in memcache together with the statistics deltas its
+moves have queued and the time it first changed since it was last written
+to the datastore. Moves read and update the cached copy with
+compare-and-set, so a mid-game move costs a few memcache calls and no
+datastore commit. Changed games are listed in sharded memcache sets and
+written back in batches by flush(), run every minute by cron. The end of a
+game and a cancel are written through straight away, together with the
+Score and the players, and the move or cancel fails if they can't be.
+
+Every write checks that the datastore holds an older version of the game,
+so a late flush never overwrites a newer state. The statistics deltas of
+the games written are summed and recorded with one counter update, outside
+the games' transactions. If a game is evicted from
+memcache it is rebuilt from the datastore on its next move: moves made
+since the last write are lost, and the version is moved past the last
+published one so pollers pick up the rebuilt game."""
+
+import logging
+import time
+import zlib
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import ai
+import stats
+from models import ArchivedGame
+from models import Game
+
+GAME_PREFIX = 'active_game:'
+DIRTY_PREFIX = 'dirty_games:'
+DIRTY_SHARDS = 20
+CAS_RETRIES = 5
+# a move writes its game through itself if the flush is this late (seconds)
+MAX_DIRTY_AGE = 3 * 60
+FINAL_WRITE_RETRIES = 3
+XG_LIMIT = 25  # entity groups in a cross-group transaction
+
+
+def _entry(game, counts=None, dirty_since=None):
+    game.pack()
+    return {'game': game, 'version': game.version, 'stats': counts or {},
+            'dirty_since': dirty_since}
+
+
+def _get_stored(key):
+    """The datastore copy of a game, looked up in the archive if it was
+    archived"""
+    return _get_stored_multi([key])[0]
+
+
+def _get_stored_multi(keys):
+    """_get_stored for many keys with at most two batched gets"""
+    games = ndb.get_multi(keys)
+    missing = [key for key, game in zip(keys, games) if not game]
+    archived = dict(zip(missing, ArchivedGame.get_games(missing))) \
+        if missing else {}
+    return [game or archived.get(key) for key, game in zip(keys, games)]
+
+
+def _load(client, key):
+    """Returns (game, entry), rebuilding the entry from the datastore if it
+    isn't cached. client holds the cas token of the entry. entry is None
+    for finished and cancelled games, which aren't cached, and game is None
+    if the game doesn't exist."""
+    loaded = _load_multi(client, [key])
+    if key not in loaded:
+        raise datastore_errors.TransactionFailedError(
+            'Could not load game %s into the cache' % key.urlsafe())
+    return loaded[key]
+
+
+def _load_multi(client, keys):
+    """_load for many games, with one memcache get_multi per attempt and
+    batched gets and one add_multi for the games rebuilt from the
+    datastore. Returns a dict game key -> (game, entry); games that could
+    not be loaded into the cache are left out."""
+    loaded = {}
+    pending = list(keys)
+    for _ in range(CAS_RETRIES):
+        if not pending:
+            break
+        entries = client.get_multi([key.urlsafe() for key in pending],
+                                   key_prefix=GAME_PREFIX, for_cas=True)
+        missing = []
+        for key in pending:
+            entry = entries.get(key.urlsafe())
+            if entry is None:
+                missing.append(key)
+            else:
+                game = entry['game']
+                game._write_behind = True
+                loaded[key] = (game, entry)
+        if not missing:
+            break
+        published = Game.get_cached_versions(missing)
+        rebuilt = {}
+        for key, game in zip(missing, _get_stored_multi(missing)):
+            if not game or game.game_over or game.game_cancelled:
+                loaded[key] = (game, None)
+                continue
+            if published.get(key, -1) > game.version:
+                logging.warning('Rebuilding game %s at version %d, the cache '
+                                'had version %d', key.urlsafe(), game.version,
+                                published[key])
+                game.version = published[key] + 1
+            rebuilt[key.urlsafe()] = _entry(game)
+        if rebuilt:
+            client.add_multi(rebuilt, key_prefix=GAME_PREFIX)
+        # read back with cas tokens, or the entry another request added
+        pending = [key for key in missing if key.urlsafe() in rebuilt]
+    return loaded
+
+
+def _store(client, game, entry):
+    """Replaces the entry loaded by _load with the game's new state.
+    Returns the new entry, or None if the entry changed in the meantime."""
+    return _store_multi(client, [(game, entry)]).get(game.key)
+
+
+def _store_multi(client, changes):
+    """_store for a list of (game, entry) with one cas_multi. Returns a
+    dict game key -> new entry of the games stored; the others changed in
+    the meantime."""
+    new_entries = {}
+    for game, entry in changes:
+        counts = dict(entry['stats'])
+        for name, delta in (getattr(game, '_pending_stats', None) or
+                            {}).items():
+            counts[name] = counts.get(name, 0) + delta
+        game._pending_stats = None
+        new_entries[game.key.urlsafe()] = _entry(
+            game, counts, entry['dirty_since'] or time.time())
+    failed = set(client.cas_multi(new_entries, key_prefix=GAME_PREFIX)
+                 if new_entries else [])
+    stored, newly_dirty = {}, {}
+    for game, entry in changes:
+        urlsafe = game.key.urlsafe()
+        if urlsafe in failed:
+            continue
+        stored[game.key] = new_entries[urlsafe]
+        if entry['dirty_since'] is None:
+            newly_dirty[urlsafe] = new_entries[urlsafe]['dirty_since']
+    if newly_dirty:
+        _register(newly_dirty)
+    return stored
+
+
+def _shard(urlsafe):
+    return DIRTY_PREFIX + str(zlib.crc32(urlsafe) % DIRTY_SHARDS)
+
+
+def _register(dirty):
+    """Lists changed games (a dict urlsafe key -> dirty since) so the next
+    flush writes them, with one get_multi and one add_multi or cas_multi
+    per attempt for all their shards"""
+    client = memcache.Client()
+    by_shard = {}
+    for urlsafe, dirty_since in dirty.items():
+        by_shard.setdefault(_shard(urlsafe), {})[urlsafe] = dirty_since
+    for _ in range(CAS_RETRIES):
+        if not by_shard:
+            return
+        current = client.get_multi(list(by_shard), for_cas=True)
+        added = dict((name, games) for name, games in by_shard.items()
+                     if name not in current)
+        updated = {}
+        for name, games in by_shard.items():
+            if name in current:
+                updated[name] = dict(current[name])
+                updated[name].update(games)
+        failed = set(client.add_multi(added) if added else [])
+        failed.update(client.cas_multi(updated) if updated else [])
+        by_shard = dict((name, by_shard[name]) for name in failed)
+    for games in by_shard.values():
+        for urlsafe in games:
+            logging.warning('Could not list game %s for the flush, the next '
+                            'move after %d seconds writes it', urlsafe,
+                            MAX_DIRTY_AGE)
+
+
+def _unregister(name, flushed):
+    """Removes flushed games from a dirty shard, unless they changed again
+    (and were listed with a new time) in the meantime"""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        dirty = client.gets(name)
+        if dirty is None:
+            return
+        for urlsafe, dirty_since in flushed.items():
+            if dirty.get(urlsafe) == dirty_since:
+                del dirty[urlsafe]
+        if client.cas(name, dirty):
+            return
+
+
+def _is_newer(game, stored):
+    """True if the cached game is a later state than the datastore's"""
+    return (stored is not None and not stored.game_over and
+            not stored.game_cancelled and stored.version < game.version)
+
+
+@ndb.transactional_tasklet(xg=True, retries=5)
+def _write(game):
+    """Writes a cached game, with its result if it is finished, unless the
+    datastore already has this or a later state. Returns True if written."""
+    stored = yield game.key.get_async()
+    if not _is_newer(game, stored):
+        raise ndb.Return(False)
+    if game.game_over:
+        game.write_result()
+    else:
+        yield game.put_async()
+    raise ndb.Return(True)
+
+
+@ndb.transactional_tasklet(xg=True, retries=5)
+def _write_active(games):
+    """Writes up to XG_LIMIT active cached games with one get_multi and one
+    put_multi, skipping those the datastore already has in this or a later
+    state. Returns the games written."""
+    stored = yield ndb.get_multi_async([game.key for game in games])
+    games = [game for game, current in zip(games, stored)
+             if _is_newer(game, current)]
+    yield ndb.put_multi_async(games)
+    raise ndb.Return(games)
+
+
+@ndb.tasklet
+def _write_ended(game):
+    """_write for the flush: returns the games written, like _write_active"""
+    written = yield _write(game)
+    raise ndb.Return([game] if written else [])
+
+
+def _record_stats(entries):
+    """Records the statistics queued by written entries as one update of
+    one counter shard. Game writes don't join a shard's entity group, so
+    concurrent writes never contend on the 20 shards."""
+    totals = {}
+    for entry in entries:
+        for name, delta in entry['stats'].items():
+            totals[name] = totals.get(name, 0) + delta
+    try:
+        stats.record(totals)
+    except datastore_errors.Error:
+        logging.exception('Recording the statistics of %d games failed',
+                          len(entries))
+
+
+def _settle(client, entry, written):
+    """Updates the cache after a write of entry: finished and cancelled
+    games are dropped, active ones are marked clean unless they changed in
+    the meantime. The statistics deltas of entry are only taken off the
+    cached ones if this write recorded them (written); when another writer
+    stored the version first, that writer takes them off. Returns True if
+    nothing is left to write."""
+    game = entry['game']
+    name = GAME_PREFIX + game.key.urlsafe()
+    if game.game_over or game.game_cancelled:
+        client.delete(name)
+        return True
+    for _ in range(CAS_RETRIES):
+        current = client.gets(name)
+        if current is None:
+            return True
+        if written:
+            counts = dict(current['stats'])
+            for counter, delta in entry['stats'].items():
+                counts[counter] = counts.get(counter, 0) - delta
+            current['stats'] = dict((counter, delta) for counter, delta
+                                    in counts.items() if delta)
+        clean = current['version'] == entry['version']
+        if clean:
+            current['dirty_since'] = None
+        if client.cas(name, current):
+            return clean
+    logging.warning('Could not mark game %s as written', game.key.urlsafe())
+    return False
+
+
+def _write_through(client, entry):
+    """Writes an entry to the datastore and settles the cache. The end or
+    cancel of a game has to be durable: it is retried, and if it still
+    fails TransactionFailedError is raised so the player hears about it.
+    Active games are written on a best effort basis; the flush retries
+    them."""
+    game = entry['game']
+    final = game.game_over or game.game_cancelled
+    for _ in range(FINAL_WRITE_RETRIES if final else 1):
+        try:
+            written = _write(game).get_result()
+        except datastore_errors.Error:
+            logging.exception('Writing game %s failed', game.key.urlsafe())
+            continue
+        if written:
+            _record_stats([entry])
+        _settle(client, entry, written)
+        return
+    if final:
+        raise datastore_errors.TransactionFailedError(
+            'The game could not be saved')
+
+
+def _write_through_multi(client, entries):
+    """_write_through for many entries: the writes run concurrently and
+    the statistics of the games written are recorded with one update. An
+    ended game whose write fails is retried like _write_through. Returns
+    the keys of the ended games that could not be saved."""
+    futures = [(entry, _write(entry['game'])) for entry in entries]
+    written, unsaved = [], []
+    for entry, future in futures:
+        game = entry['game']
+        try:
+            saved = future.get_result()
+        except datastore_errors.Error:
+            logging.exception('Writing game %s failed', game.key.urlsafe())
+            if game.game_over or game.game_cancelled:
+                try:
+                    _write_through(client, entry)
+                except datastore_errors.TransactionFailedError:
+                    unsaved.append(game.key)
+            continue
+        if saved:
+            written.append(entry)
+        _settle(client, entry, saved)
+    if written:
+        _record_stats(written)
+    return unsaved
+
+
+def _play(game, user_key, move):
+    """Plays a move and the computer's reply, if it is a computer game.
+    Returns a message for the player. Raises ValueError on an illegal move."""
+    message = game.make_move(user_key, move)
+    if game.computer and game.next_move == game.computer and not game.game_over:
+        message = game.make_computer_move()
+    return message
+
+
+def _apply(game, moves, ai_deadline=None):
+    """Plays a sequence of (user_key, move). Returns an (ok, message) tuple
+    per move. In a computer game a move is only played if a full search
+    for the reply fits before ai_deadline (a time.time() value)."""
+    results = []
+    for user_key, move in moves:
+        if game.game_over or game.game_cancelled:
+            results.append((False, 'Game already over!' if game.game_over
+                            else 'This Game is cancelled'))
+            continue
+        if (game.computer and ai_deadline is not None and
+                time.time() + ai.TIME_BUDGET > ai_deadline):
+            results.append((False, 'Not applied, no time was left for the '
+                                   'computer\'s reply'))
+            continue
+        try:
+            results.append((True, _play(game, user_key, move)))
+        except ValueError as e:
+            results.append((False, str(e)))
+    return results
+
+
+def play(key, moves):
+    """Plays a sequence of (user_key, move) in one game. Returns the game
+    (None if it doesn't exist) and an (ok, message) tuple per move.
+    Raises datastore_errors.TransactionFailedError if the game keeps
+    changing underneath, or if the game ended and could not be saved."""
+    played, failed = play_multi({key: moves})
+    if key in failed:
+        raise datastore_errors.TransactionFailedError(failed[key])
+    return played[key]
+
+
+def play_multi(moves_by_game, ai_deadline=None):
+    """play() for many games. Every attempt loads the games with one
+    memcache get_multi and stores them with one cas_multi, and only the
+    games whose cas failed are tried again. Games that ended, and games
+    the flush is late for, are then written concurrently.
+    Args:
+        moves_by_game: A dict game key -> list of (user_key, move)
+        ai_deadline: Optional time.time() after which no more computer
+            replies are searched; moves in computer games that don't fit
+            are reported as not applied
+    Returns:
+        (played, failed): played maps game keys to (game, results) as
+        returned by play(); failed maps the keys of the games whose moves
+        could not be applied or saved to the reason."""
+    client = memcache.Client()
+    played, to_write = {}, []
+    pending = list(moves_by_game)
+    for _ in range(CAS_RETRIES):
+        if not pending:
+            break
+        loaded = _load_multi(client, pending)
+        changed = []
+        for key in pending:
+            if key not in loaded:
+                continue
+            game, entry = loaded[key]
+            if game is None:
+                played[key] = (None, [(False, 'Game not found!')] *
+                               len(moves_by_game[key]))
+                continue
+            results = _apply(game, moves_by_game[key], ai_deadline)
+            if entry is None or not any(ok for ok, _ in results):
+                if entry is not None and (game.game_over or
+                                          game.game_cancelled):
+                    # a game whose final write failed earlier
+                    to_write.append(entry)
+                played[key] = (game, results)
+            else:
+                changed.append((game, entry, results))
+        stored = _store_multi(client, [(game, entry)
+                                       for game, entry, _ in changed])
+        for game, _, results in changed:
+            entry = stored.get(game.key)
+            if entry:
+                played[game.key] = (game, results)
+                if (game.game_over or
+                        time.time() - entry['dirty_since'] > MAX_DIRTY_AGE):
+                    to_write.append(entry)
+        pending = [key for key in pending if key not in played]
+    failed = dict.fromkeys(pending, 'The game was updated at the same time')
+    for key in _write_through_multi(client, to_write):
+        del played[key]
+        failed[key] = 'The game could not be saved'
+    return played, failed
+
+
+def cancel(key):
+    """Cancels a game and writes it through. Returns the game (None if it
+    doesn't exist); finished games are returned unchanged. Raises
+    datastore_errors.TransactionFailedError if the cancel isn't saved."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        game, entry = _load(client, key)
+        if entry is None or game.game_over or game.game_cancelled:
+            if entry is not None:
+                _write_through(client, entry)
+            return game
+        game.game_cancel()
+        entry = _store(client, game, entry)
+        if entry:
+            _write_through(client, entry)
+            return game
+    raise datastore_errors.TransactionFailedError(
+        'The game was updated at the same time')
+
+
+def get(key):
+    """Returns the current state of a game: the cached copy while it is
+    active, otherwise the datastore entity or its archived copy (None if it
+    doesn't exist)"""
+    entry = memcache.get(GAME_PREFIX + key.urlsafe())
+    return entry['game'] if entry else _get_stored(key)
+
+
+def get_multi(keys):
+    """get() for many games: cached copies with one memcache call, the rest
+    with one batched datastore get. Archived games aren't looked up."""
+    keys = list(keys)
+    entries = memcache.get_multi([key.urlsafe() for key in keys],
+                                 key_prefix=GAME_PREFIX)
+    missing = [key for key in keys if key.urlsafe() not in entries]
+    stored = dict(zip(missing, ndb.get_multi(missing)))
+    return [entries[key.urlsafe()]['game'] if key.urlsafe() in entries
+            else stored[key] for key in keys]
+
+
+def prime(game):
+    """Caches a game that was just created"""
+    memcache.add(GAME_PREFIX + game.key.urlsafe(), _entry(game))
+
+
+def flush():
+    """Writes every changed game to the datastore. Per dirty shard, active
+    games are written XG_LIMIT at a time with put_multi and ended games
+    (whose write-through failed) one transaction each, all concurrently,
+    and their statistics are recorded with one counter update. Returns the
+    number of games written."""
+    client = memcache.Client()
+    written = 0
+    for shard in range(DIRTY_SHARDS):
+        name = DIRTY_PREFIX + str(shard)
+        dirty = memcache.get(name)
+        if not dirty:
+            continue
+        entries = memcache.get_multi(list(dirty), key_prefix=GAME_PREFIX)
+        # games that were evicted or are already clean have nothing to write
+        flushed = dict((urlsafe, dirty_since)
+                       for urlsafe, dirty_since in dirty.items()
+                       if urlsafe not in entries or
+                       entries[urlsafe]['dirty_since'] is None)
+        active, ended = [], []
+        for entry in entries.values():
+            if entry['dirty_since'] is not None:
+                game = entry['game']
+                (ended if game.game_over or game.game_cancelled
+                 else active).append(entry)
+        futures = [([entry], _write_ended(entry['game'])) for entry in ended]
+        futures += [(chunk, _write_active([entry['game'] for entry in chunk]))
+                    for chunk in (active[i:i + XG_LIMIT]
+                                  for i in range(0, len(active), XG_LIMIT))]
+        saved, settle = [], []
+        for chunk, future in futures:
+            try:
+                keys = set(game.key for game in future.get_result())
+            except datastore_errors.Error:
+                logging.exception('Writing %d games failed', len(chunk))
+                continue
+            saved += [entry for entry in chunk if entry['game'].key in keys]
+            settle += [(entry, entry['game'].key in keys) for entry in chunk]
+        if saved:
+            _record_stats(saved)
+        written += len(saved)
+        for entry, was_written in settle:
+            if _settle(client, entry, was_written):
+                urlsafe = entry['game'].key.urlsafe()
+                flushed[urlsafe] = dirty[urlsafe]
+        _unregister(name, flushed)
+    logging.info('Flushed %d games from the cache', written)
+    return written
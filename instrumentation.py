@@ -0,0 +1,200 @@
+"""instrumentation.py - Per-request RPC and timing instrumentation.
+
+Endpoint methods and handlers decorated with @instrumented get a request
+record for the duration of the call. apiproxy hooks count and time every
+datastore, memcache and task queue RPC made while a record is active, and
+timed() sections (e.g. form serialization) add their own durations.
+Finished records are aggregated per endpoint in memory and flushed to
+memcache in batches; requests that exceed their RPC budget (RPC_BUDGET
+unless the endpoint sets its own) are logged with their RPC breakdown.
+main.StatsHandler serves the aggregates to admins."""
+
+import functools
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+RPC_BUDGET = 20  # RPCs per request before a request is flagged
+FLUSH_INTERVAL = 30  # seconds between flushes of the local aggregates
+MEMCACHE_PREFIX = 'rpcstats:'
+
+SERVICES = {'datastore_v3': 'datastore', 'memcache': 'memcache',
+            'taskqueue': 'taskqueue'}
+METRICS = ['requests', 'total_ms', 'serialize_ms', 'over_budget', 'rpcs']
+for _service in sorted(set(SERVICES.values())) + ['other']:
+    METRICS += ['{}_rpcs'.format(_service), '{}_ms'.format(_service)]
+
+# Names of every instrumented endpoint and handler
+ENDPOINTS = []
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending = {}  # endpoint -> metric -> value, not yet flushed to memcache
+_totals = {}  # endpoint -> metric -> value, since this instance started
+_last_flush = [time.time()]
+
+
+class _Record(object):
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.start = time.time()
+        self.metrics = dict.fromkeys(METRICS, 0)
+        self.calls = {}  # 'service.Call' -> count, for over budget logs
+        self.rpc_starts = {}
+        self.sections = {}
+
+    def rpc_started(self, service, call, request):
+        self.rpc_starts[id(request)] = time.time()
+
+    def rpc_finished(self, service, call, request):
+        started = self.rpc_starts.pop(id(request), None)
+        elapsed = (time.time() - started) * 1000 if started else 0
+        kind = SERVICES.get(service, 'other')
+        self.metrics['rpcs'] += 1
+        self.metrics[kind + '_rpcs'] += 1
+        self.metrics[kind + '_ms'] += elapsed
+        name = '{}.{}'.format(service, call)
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+
+def _current():
+    return getattr(_local, 'record', None)
+
+
+def _pre_call_hook(service, call, request, response):
+    record = _current()
+    if record:
+        record.rpc_started(service, call, request)
+
+
+def _post_call_hook(service, call, request, response):
+    record = _current()
+    if record:
+        record.rpc_finished(service, call, request)
+
+
+def install_hooks():
+    """Registers the apiproxy hooks. Safe to call more than once."""
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('instrumentation_pre', _pre_call_hook)
+    apiproxy.GetPostCallHooks().Append('instrumentation_post', _post_call_hook)
+
+
+class timed(object):
+    """Context manager that adds the time spent in a section to the current
+    request, e.g. `with timed('serialize'):`. Nested sections of the same
+    name are only counted once."""
+
+    def __init__(self, section):
+        self.section = section
+
+    def __enter__(self):
+        record = _current()
+        if record:
+            depth = record.sections.get(self.section, 0)
+            record.sections[self.section] = depth + 1
+            if not depth:
+                self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        record = _current()
+        if record:
+            depth = record.sections[self.section] - 1
+            record.sections[self.section] = depth
+            if not depth:
+                key = self.section + '_ms'
+                record.metrics[key] = (record.metrics.get(key, 0) +
+                                       (time.time() - self.start) * 1000)
+
+
+def timed_method(section):
+    """Decorator form of timed()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(section):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrumented(func=None, name=None, budget=RPC_BUDGET):
+    """Decorates an endpoint method or handler method so its RPCs and
+    timings are recorded under name (the function name by default).
+    Requests making more than budget RPCs are flagged."""
+    if func is None:
+        return functools.partial(instrumented, name=name, budget=budget)
+    name = name or func.__name__
+    ENDPOINTS.append(name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current():  # already inside an instrumented call
+            return func(*args, **kwargs)
+        record = _local.record = _Record(name, budget)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.record = None
+            _finish(record)
+    return wrapper
+
+
+def _finish(record):
+    record.metrics['requests'] = 1
+    record.metrics['total_ms'] = (time.time() - record.start) * 1000
+    if record.metrics['rpcs'] > record.budget:
+        record.metrics['over_budget'] = 1
+        logging.warning('%s made %d RPCs (budget %d): %s', record.name,
+                        record.metrics['rpcs'], record.budget,
+                        ', '.join('{} x{}'.format(call, count) for call, count
+                                  in sorted(record.calls.items())))
+    with _lock:
+        for target in (_pending, _totals):
+            metrics = target.setdefault(record.name, dict.fromkeys(METRICS, 0))
+            for metric, value in record.metrics.items():
+                metrics[metric] = metrics.get(metric, 0) + value
+        due = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def flush():
+    """Adds the aggregates collected since the last flush to memcache"""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    offsets = {}
+    for endpoint, metrics in pending.items():
+        for metric, value in metrics.items():
+            if value:
+                offsets['{}:{}'.format(endpoint, metric)] = int(round(value))
+    if offsets:
+        memcache.offset_multi(offsets, key_prefix=MEMCACHE_PREFIX,
+                              initial_value=0)
+
+
+def get_stats():
+    """Returns {'instance': ..., 'global': ...} where each maps endpoint ->
+    metric -> value. Global values are summed over all instances' flushes
+    in memcache; instance values are this instance's since it started."""
+    keys = ['{}:{}'.format(endpoint, metric)
+            for endpoint in ENDPOINTS for metric in METRICS]
+    cached = memcache.get_multi(keys, key_prefix=MEMCACHE_PREFIX)
+    global_stats = {}
+    for key, value in cached.items():
+        endpoint, metric = key.rsplit(':', 1)
+        global_stats.setdefault(endpoint, {})[metric] = value
+    with _lock:
+        instance_stats = dict((endpoint, dict(metrics))
+                              for endpoint, metrics in _totals.items())
+    return {'instance': instance_stats, 'global': global_stats}
+
+
+install_hooks()
@@ -0,0 +1,121 @@
+"""leaderboard.py - Materialized points leaderboard.
+
+Every User stores its points, so the top of the leaderboard is an indexed
+query on User.points. A user's rank is one plus the number of users with
+more points; those counts are kept in RankBucket entities (one per points
+value, sharded so that popular scores don't contend) which Game.end_game
+updates in the same transaction as the users. The bucket histogram and the
+top of the leaderboard are served from memcache for up to CACHE_TIME
+seconds; finished games don't drop them, so under load the cache keeps
+hitting and ranks lag by at most that long."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MEMCACHE_HISTOGRAM = 'leaderboard:histogram'
+MEMCACHE_TOP = 'leaderboard:top'
+BUCKET_SHARDS = 20
+TOP_SIZE = 100
+CACHE_TIME = 60  # seconds
+
+
+class RankBucket(ndb.Model):
+    """Number of users (in this shard) that have exactly `points` points.
+    Users with no points are not counted."""
+    points = ndb.IntegerProperty(required=True)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _bucket_key(points):
+    shard = random.randint(0, BUCKET_SHARDS - 1)
+    return ndb.Key(RankBucket, '{}-{}'.format(points, shard))
+
+
+def update_buckets(changes):
+    """Moves users between points buckets.
+    Args:
+        changes: A list of (old_points, new_points) tuples, one per user
+    Returns:
+        The RankBucket entities to put, so the caller can write them in the
+        same batch (and transaction) as the users."""
+    deltas = {}
+    for old_points, new_points in changes:
+        if old_points == new_points:
+            continue
+        if old_points > 0:
+            key = _bucket_key(old_points)
+            deltas[key] = deltas.get(key, 0) - 1
+        if new_points > 0:
+            key = _bucket_key(new_points)
+            deltas[key] = deltas.get(key, 0) + 1
+    keys = deltas.keys()
+    buckets = []
+    for key, bucket in zip(keys, ndb.get_multi(keys)):
+        if not bucket:
+            bucket = RankBucket(key=key, points=int(key.id().split('-')[0]))
+        bucket.count += deltas[key]
+        buckets.append(bucket)
+    return buckets
+
+
+def invalidate():
+    """Drops the cached histogram and top of the leaderboard"""
+    memcache.delete_multi([MEMCACHE_HISTOGRAM, MEMCACHE_TOP])
+
+
+def get_histogram():
+    """Returns a list of (points, users) pairs, highest points first"""
+    histogram = memcache.get(MEMCACHE_HISTOGRAM)
+    if histogram is None:
+        totals = {}
+        for bucket in RankBucket.query():
+            totals[bucket.points] = totals.get(bucket.points, 0) + bucket.count
+        histogram = sorted(((points, count) for points, count
+                            in totals.iteritems() if count),
+                           reverse=True)
+        memcache.set(MEMCACHE_HISTOGRAM, histogram, time=CACHE_TIME)
+    return histogram
+
+
+def rank_of(points, histogram=None):
+    """Returns the rank of a user with the given points. Users with equal
+    points share a rank."""
+    if histogram is None:
+        histogram = get_histogram()
+    return 1 + sum(count for bucket_points, count in histogram
+                   if bucket_points > points)
+
+
+def top_users(n=TOP_SIZE):
+    """Returns up to n of the highest ranked Users, served from memcache"""
+    from models import User
+    users = memcache.get(MEMCACHE_TOP)
+    if users is None:
+        users = User.query().order(-User.points, User.name).fetch(TOP_SIZE)
+        memcache.set(MEMCACHE_TOP, users, time=CACHE_TIME)
+    return users[:n]
+
+
+def rebuild():
+    """Recomputes every user's points and all RankBuckets from the User
+    counters. Used to backfill users created before the leaderboard."""
+    from models import User
+    ndb.delete_multi(RankBucket.query().iter(keys_only=True))
+    totals = {}
+    users, cursor, more = User.query().fetch_page(500)
+    while users:
+        for user in users:
+            user.points = user.totlal_points
+            if user.points:
+                totals[user.points] = totals.get(user.points, 0) + 1
+        ndb.put_multi(users)
+        if not more:
+            break
+        users, cursor, more = User.query().fetch_page(500,
+                                                      start_cursor=cursor)
+    ndb.put_multi([RankBucket(id='{}-0'.format(points), points=points,
+                              count=count)
+                   for points, count in totals.iteritems()])
+    invalidate()
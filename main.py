@@ -2,65 +2,165 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import TicTacToeApi
-
-from models import User
-from models import Game
+from google.appengine.api import taskqueue
+import archive
+import gamecache
+import instrumentation
+from instrumentation import instrumented
+import leaderboard
+import migrations
+import reminders
+import stats
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @instrumented(name='SendReminderEmail')
     def get(self):
         """Send a reminder email to each User with an email about games.
         Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        games = Game.query(Game.game_over == False)
-        for game in games:
-            if not game.game_cancelled:
-                user_one = User.query(User.key == game.user_o).get()
-                user_two = User.query(User.key == game.user_x).get()
-                subject = 'This is a reminder!'
-                body = 'Hello {}, finish the game'
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               (user_one.email, user_two.email),
-                               subject,
-                               body)
+        reminders.start('active')
+
 
 class SendReminderEmailForIncompleteGame(webapp2.RequestHandler):
+    @instrumented(name='SendReminderEmailForIncompleteGame')
     def get(self):
         """Send a reminder email to each User with an email about games.
         Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        games = Game.query(Game.game_cancelled == True)
+        reminders.start('cancelled')
 
-        for game in games:
-            user_one = User.query(User.key == game.user_o).get()
-            user_two = User.query(User.key == game.user_x).get()
-            subject = 'This is a reminder!'
-            body = 'Hello {}, try out Guess A Number!'
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           (user_one.email,user_two.email),
-                           subject,
-                           body)
 
+class ReminderPage(webapp2.RequestHandler):
+    @instrumented(name='ReminderPage')
+    def post(self):
+        """Fan out the reminder mails for one page of games."""
+        cursor = self.request.get('cursor') or None
+        reminders.process_page(self.request.get('reminder'),
+                               self.request.get('run_id'),
+                               int(self.request.get('page')),
+                               cursor)
+        self.response.set_status(204)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    @instrumented(name='SendReminderBatch')
+    def post(self):
+        """Send one batch of reminder mails."""
+        reminders.send_batch(self.request.get('reminder'),
+                             self.request.get('run_id'),
+                             json.loads(self.request.get('recipients')))
+        self.response.set_status(204)
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+    @instrumented(name='UpdateAverageMovesRemaining')
+    def post(self):
+        """Reload the game statistics counters into memcache."""
+        stats.get_counts()
+        self.response.set_status(204)
+
+
+class MigrateGameEncoding(webapp2.RequestHandler):
+    @instrumented(name='MigrateGameEncoding')
+    def post(self):
+        """Rewrite one batch of Games stored with pickled boards in the packed
+        encoding, then chain the next batch."""
+        cursor = migrations.migrate_game_encoding(
+            self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/tasks/migrate_game_encoding',
+                          params={'cursor': cursor})
+        self.response.set_status(204)
+
+
+class BackfillGameIndex(webapp2.RequestHandler):
+    @instrumented(name='BackfillGameIndex')
+    def post(self):
+        """Set players and status on one batch of Games, then chain the
+        next batch."""
+        cursor = migrations.backfill_game_index(
+            self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/tasks/backfill_game_index',
+                          params={'cursor': cursor})
+        self.response.set_status(204)
+
+
+class SeedGameStats(webapp2.RequestHandler):
+    @instrumented(name='SeedGameStats')
+    def post(self):
+        """Count one batch of existing games into the statistics counters,
+        then chain the next batch."""
+        following = migrations.seed_game_stats(
+            self.request.get('kind') or 'Game',
+            self.request.get('cursor') or None)
+        if following:
+            kind, cursor = following
+            taskqueue.add(url='/tasks/seed_game_stats',
+                          params={'kind': kind, 'cursor': cursor or ''})
+        self.response.set_status(204)
+
+
+class FlushGameCache(webapp2.RequestHandler):
+    @instrumented(name='FlushGameCache')
+    def get(self):
+        """Write the games changed in the write-behind cache to the
+        datastore. Called every minute using a cron job"""
+        gamecache.flush()
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Move games that ended more than max_age_days (default 30) ago to
+        the archive. Called every day using a cron job"""
+        self.post()
+
+    @instrumented(name='ArchiveGames')
     def post(self):
-        """Update game listing announcement in memcache."""
-        TicTacToeApi._cache_average_attempts()
+        """Archive one batch, then chain the next batch."""
+        max_age_days = int(self.request.get('max_age_days') or
+                           archive.MAX_AGE_DAYS)
+        if archive.archive_games(max_age_days):
+            taskqueue.add(url='/crons/archive_games',
+                          params={'max_age_days': max_age_days})
         self.response.set_status(204)
 
 
+class RebuildLeaderboard(webapp2.RequestHandler):
+    @instrumented(name='RebuildLeaderboard')
+    def post(self):
+        """Recompute stored points and rank buckets for every user."""
+        leaderboard.rebuild()
+        self.response.set_status(204)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the RPC and timing aggregates of every endpoint and the
+        throughput of the latest reminder runs as JSON. Admin only (see
+        app.yaml)."""
+        import api  # registers the endpoint names
+        instrumentation.flush()
+        result = instrumentation.get_stats()
+        result['reminders'] = reminders.get_recent_stats()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(result, indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
     ('/crons/send_cancel_reminder', SendReminderEmailForIncompleteGame),
+    ('/crons/flush_games', FlushGameCache),
+    ('/crons/archive_games', ArchiveGames),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/reminders/page', ReminderPage),
+    ('/tasks/reminders/send', SendReminderBatch),
+    ('/tasks/migrate_game_encoding', MigrateGameEncoding),
+    ('/tasks/backfill_game_index', BackfillGameIndex),
+    ('/tasks/seed_game_stats', SeedGameStats),
+    ('/admin/stats', StatsHandler),
 ], debug=True)
@@ -0,0 +1,73 @@
+"""migrations.py - Online, batched data migrations. Each function handles
+one batch and returns the cursor of the next one (None when done), so the
+task handlers in main.py can chain themselves through the whole kind."""
+
+import logging
+
+from google.appengine.ext import ndb
+
+import stats
+from models import ArchivedGame
+from models import Game
+from utils import fetch_page
+
+BATCH_SIZE = 200
+
+
+@ndb.transactional_tasklet
+def _rewrite_game(key, needs_rewrite):
+    game = yield key.get_async()
+    if game and needs_rewrite(game):
+        # _pre_put_hook writes the packed encoding and the index fields
+        yield game.put_async()
+        raise ndb.Return(True)
+    raise ndb.Return(False)
+
+
+def _rewrite_games(cursor, needs_rewrite, description):
+    """Rewrites the games of one batch that need it. Each game is rewritten
+    in its own transaction, all of them concurrently, so moves made during
+    the migration are never lost."""
+    keys, next_cursor = fetch_page(Game.query(), BATCH_SIZE, cursor,
+                                   keys_only=True)
+    futures = [_rewrite_game(key, needs_rewrite) for key in keys]
+    rewritten = sum(1 for future in futures if future.get_result())
+    logging.info('Rewrote %d of %d games %s', rewritten, len(keys),
+                 description)
+    return next_cursor
+
+
+def migrate_game_encoding(cursor=None):
+    """Rewrites one batch of Games from pickled to packed boards"""
+    return _rewrite_games(cursor, lambda game: game.needs_migration,
+                          'to the packed encoding')
+
+
+def backfill_game_index(cursor=None):
+    """Sets players and status on one batch of Games written before they
+    existed"""
+    return _rewrite_games(cursor, lambda game: game.needs_index,
+                          'with players and status')
+
+
+def seed_game_stats(kind='Game', cursor=None):
+    """Adds one batch of Games, then of ArchivedGames, to the statistics
+    counters, which the first batch clears. Returns the (kind, cursor) of
+    the next batch, None when done. Games that change while it runs can be
+    counted twice, so run it once after deploying the counters, before
+    they are used."""
+    if kind == 'Game' and cursor is None:
+        stats.reset()
+    model = Game if kind == 'Game' else ArchivedGame
+    entities, next_cursor = fetch_page(model.query(), BATCH_SIZE, cursor)
+    totals = {}
+    for entity in entities:
+        game = entity if kind == 'Game' else entity.to_game()
+        for name, count in game.seed_counts().items():
+            totals[name] = totals.get(name, 0) + count
+    stats.record(totals)
+    logging.info('Added %d %s entities to the statistics counters',
+                 len(entities), kind)
+    if next_cursor:
+        return kind, next_cursor
+    return ('ArchivedGame', None) if kind == 'Game' else None
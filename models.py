@@ -4,9 +4,30 @@ classes they can include methods (such as 'to_form' and 'new_game')."""
 
 import random
 from datetime import date
+from datetime import datetime
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+import ai
+import codec
+import leaderboard
+import rating
+import stats
+from engine import Board
+from rating import INITIAL_RATING
+from instrumentation import timed_method
+from utils import LRUCache
+from utils import get_user_names
+
+MEMCACHE_USER_NAME = 'user_name:{}'
+MEMCACHE_GAME_VERSION = 'game_version:{}'
+GAME_ACTIVE, GAME_FINISHED, GAME_CANCELLED = 'active', 'finished', 'cancelled'
+RESULT_COUNTERS = {'user_x': 'x_wins', 'user_o': 'o_wins', 'tie': 'ties'}
+
+# username -> User key, shared by every request served by this instance
+_user_keys = LRUCache(maxsize=5000)
+
 
 class User(ndb.Model):
     """User profile"""
@@ -15,6 +36,8 @@ class User(ndb.Model):
     wins = ndb.IntegerProperty(default=0)
     ties = ndb.IntegerProperty(default=0)
     total_played = ndb.IntegerProperty(default=0)
+    points = ndb.IntegerProperty(default=0)  # stored copy for the leaderboard
+    rating = ndb.FloatProperty(default=INITIAL_RATING, indexed=False)
 
     @property
     def totlal_points(self):
@@ -37,24 +60,85 @@ class User(ndb.Model):
         else:
             return float(0)
 
-    def to_form(self):
-        return UserRankingForm(name=self.name,
+    @timed_method('serialize')
+    def to_form(self, rank=None):
+        form = UserRankingForm(name=self.name,
                         email=self.email,
                         wins=self.wins,
                         ties=self.ties,
                         total_played=self.total_played,
                         no_lose_percentage=self.no_lose_percentage,
-                        points=self.totlal_points)
+                        points=self.totlal_points,
+                        rank=rank,
+                        win_percentage=float(self.win_percentage))
+        if not self._projection:  # rating isn't part of the ranking index
+            form.rating = int(round(self.rating))
+        return form
 
     @classmethod
     def get_user_by_name(cls, username):
         """Gets User by his name. Return None on no User found"""
-        return User.query(User.name == username).get()
+        key = cls.get_key_by_name(username)
+        return key.get() if key else None
+
+    @classmethod
+    def get_key_by_name(cls, username):
+        """Resolves a username to a User key through the in-process cache,
+        memcache and then the UserName index. Return None on no User found"""
+        if not username:
+            return None
+        key = _user_keys.get(username)
+        if key:
+            return key
+        urlsafe = memcache.get(MEMCACHE_USER_NAME.format(username))
+        if urlsafe:
+            key = ndb.Key(urlsafe=urlsafe)
+        else:
+            index = UserName.get_by_id(username)
+            if index:
+                key = index.user
+            else:
+                # Users created before the UserName index existed
+                key = User.query(User.name == username).get(keys_only=True)
+                if not key:
+                    return None
+                UserName(id=username, user=key).put()
+            memcache.set(MEMCACHE_USER_NAME.format(username), key.urlsafe())
+        _user_keys.set(username, key)
+        return key
+
+    @classmethod
+    def cache_keys(cls, users):
+        """Adds the keys of loaded Users to the in-process name cache"""
+        for user in users:
+            _user_keys.set(user.name, user.key)
+
+    @classmethod
+    def create(cls, username, email=None):
+        """Creates a User with a unique username. Raises ValueError if the
+        name is already taken."""
+        if cls.get_key_by_name(username):
+            raise ValueError('A User with that name already exists!')
+
+        @ndb.transactional(xg=True)
+        def txn():
+            if UserName.get_by_id(username):
+                raise ValueError('A User with that name already exists!')
+            user = User(name=username, email=email)
+            user.put()
+            UserName(id=username, user=user.key).put()
+            return user
+
+        user = txn()
+        memcache.set(MEMCACHE_USER_NAME.format(username), user.key.urlsafe())
+        _user_keys.set(username, user.key)
+        return user
 
     def update_stats(self):
-        """Adds game to user and update."""
+        """Adds game to user. The caller is responsible for the put, so the
+        end of a game can write every entity in one batch."""
         self.total_played += 1
-        self.put()
+        self.points = self.totlal_points
 
     def add_win(self):
         """Add a win"""
@@ -71,10 +155,24 @@ class User(ndb.Model):
         self.update_stats()
 
 
+class UserName(ndb.Model):
+    """Unique username index, keyed by the name so that lookups and
+    uniqueness checks are key gets rather than queries"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
 class Game(ndb.Model):
-    """Game object"""
-    board = ndb.PickleProperty(required=True)
+    """Game object. The board and move history are stored packed (see
+    codec.py) and decoded lazily through the board, history and engine
+    attributes."""
+    packed_board = ndb.BlobProperty()
+    packed_history = ndb.BlobProperty()
+    # Pickled lists written before the packed encoding; MigrateGameEncoding
+    # rewrites them
+    legacy_board = ndb.PickleProperty('board')
+    legacy_history = ndb.PickleProperty('history')
     board_size = ndb.IntegerProperty(required=True, default=3)
+    win_length = ndb.IntegerProperty()
     next_move = ndb.KeyProperty(required=True)  # The User whose turn it is
     user_x = ndb.KeyProperty(required=True, kind='User')
     user_o = ndb.KeyProperty(required=True, kind='User')
@@ -82,69 +180,365 @@ class Game(ndb.Model):
     game_cancelled = ndb.BooleanProperty(required=True, default=False)
     winner = ndb.KeyProperty()
     tie = ndb.BooleanProperty(default=False)
-    history = ndb.PickleProperty(required=True)
+    computer = ndb.KeyProperty(kind='User')  # set if one player is the AI
+    version = ndb.IntegerProperty(default=0, indexed=False)  # bumped on change
+    # Denormalized for per-user queries, set on every put
+    players = ndb.KeyProperty(kind='User', repeated=True)
+    status = ndb.StringProperty(choices=(GAME_ACTIVE, GAME_FINISHED,
+                                         GAME_CANCELLED))
+    # set on every put (the end, once it ended), unless _keep_updated is set
+    updated = ndb.DateTimeProperty()
 
     @classmethod
-    def new_game(cls, user_x, user_o, board_size=3):
-        """Creates and returns a new game"""
+    def new_game(cls, user_x, user_o, board_size=3, win_length=None,
+                 computer=None):
+        """Creates and returns a new game. Raises ValueError on an
+        unsupported board size or win length."""
+        engine = Board(board_size, win_length)
         game = Game(user_x=user_x,
                     user_o=user_o,
-                    next_move=user_x)
-        game.board = ['' for _ in range(board_size*board_size)]
-        game.history = []
+                    next_move=user_x,
+                    computer=computer)
         game.board_size = board_size
+        game.win_length = engine.win_length
+        game._engine = engine
+        game._history = []
+        game._count(games_created=1, games_active=1,
+                    cells_active=engine.cells)
         game.put()
         return game
 
-    def to_form(self,message):
-        """Returns a GameForm representation of the Game"""
+    @property
+    def engine(self):
+        """The bitboard engine for this game, decoded once per request"""
+        engine = getattr(self, '_engine', None)
+        if engine is None:
+            if self.packed_board is not None:
+                engine = codec.decode_board(self.packed_board, self.board_size,
+                                            self.win_length)
+            else:
+                engine = Board.from_cells(self.legacy_board, self.board_size,
+                                          self.win_length)
+            self._engine = engine
+        return engine
+
+    @property
+    def board(self):
+        """The board as a list of '', 'X' and 'O'"""
+        return self.engine.to_cells()
+
+    @property
+    def history(self):
+        """The moves played so far as a list of (letter, cell) tuples"""
+        history = getattr(self, '_history', None)
+        if history is None:
+            if self.packed_history is not None:
+                history = codec.decode_history(self.packed_history)
+            else:
+                history = list(self.legacy_history or [])
+            self._history = history
+        return history
+
+    @property
+    def needs_migration(self):
+        return self.legacy_board is not None or self.legacy_history is not None
+
+    def _index_fields(self):
+        if self.game_cancelled:
+            status = GAME_CANCELLED
+        elif self.game_over:
+            status = GAME_FINISHED
+        else:
+            status = GAME_ACTIVE
+        return [self.user_x, self.user_o], status
+
+    @property
+    def needs_index(self):
+        """True if players, status or updated are missing or out of date"""
+        return (self._index_fields() != (self.players, self.status) or
+                self.updated is None)
+
+    def _count(self, **deltas):
+        """Queues statistics counter deltas, recorded when the game is put"""
+        pending = getattr(self, '_pending_stats', None) or {}
+        for name, delta in deltas.items():
+            pending[name] = pending.get(name, 0) + delta
+        self._pending_stats = pending
+
+    def seed_counts(self):
+        """The statistics counters of this game alone, as if it had queued
+        its deltas since it was created. Used to seed the counters."""
+        counts = {'games_created': 1}
+        if self.game_cancelled:
+            counts['games_cancelled'] = 1
+        elif self.game_over:
+            counts.update(games_finished=1, moves_finished=self.engine.moves)
+            counts[RESULT_COUNTERS[self.result]] = 1
+        else:
+            counts.update(games_active=1, cells_active=self.engine.cells,
+                          moves_active=self.engine.moves)
+        return counts
+
+    def _count_closed(self, **deltas):
+        """Removes the game from the active game counters"""
+        self._count(games_active=-1, cells_active=-self.engine.cells,
+                    moves_active=-self.engine.moves, **deltas)
+
+    def _pre_put_hook(self):
+        pending = getattr(self, '_pending_stats', None)
+        if pending:
+            stats.record(pending)
+            self._pending_stats = None
+        self.players, self.status = self._index_fields()
+        if not getattr(self, '_keep_updated', False):
+            self.updated = datetime.utcnow()
+        self.pack()
+
+    def pack(self):
+        """Encodes the board and history into the packed properties"""
+        self.packed_board = codec.encode_board(self.engine)
+        self.packed_history = codec.encode_history(self.history)
+        self.legacy_board = None
+        self.legacy_history = None
+
+    def play(self, letter, move):
+        """Places a letter on the board. Returns True if the move wins.
+        Raises ValueError if the space is not free."""
+        won = self.engine.play(move, letter)
+        self.history.append((letter, move))
+        self.version += 1
+        self._count(moves_active=1)
+        return won
+
+    def publish_version(self):
+        """Mirrors the game's version in memcache for cheap polling. Call
+        after the change is committed."""
+        memcache.set(MEMCACHE_GAME_VERSION.format(self.key.urlsafe()),
+                     self.version)
+
+    @staticmethod
+    def publish_versions(games):
+        """publish_version for many games with one memcache call"""
+        memcache.set_multi(dict((game.key.urlsafe(), game.version)
+                                for game in games),
+                           key_prefix=MEMCACHE_GAME_VERSION.format(''))
+
+    @staticmethod
+    def get_cached_version(key):
+        """Returns the version last published for a game key, or None"""
+        return memcache.get(MEMCACHE_GAME_VERSION.format(key.urlsafe()))
+
+    @staticmethod
+    def get_cached_versions(keys):
+        """get_cached_version for many keys with one memcache call. Returns
+        a dict of the keys that have a published version."""
+        by_urlsafe = dict((key.urlsafe(), key) for key in keys)
+        versions = memcache.get_multi(
+            list(by_urlsafe), key_prefix=MEMCACHE_GAME_VERSION.format(''))
+        return dict((by_urlsafe[urlsafe], version)
+                    for urlsafe, version in versions.items())
+
+    @property
+    def user_keys(self):
+        """Every User key referenced by the game"""
+        return [self.user_x, self.user_o, self.next_move, self.winner]
+
+    @timed_method('serialize')
+    def to_form(self, message, names=None):
+        """Returns a GameForm representation of the Game. names maps User
+        keys to names; when omitted the users are fetched in one batch."""
+        if names is None:
+            names = get_user_names(self.user_keys)
         form = GameForm(urlsafe_key=self.key.urlsafe(),
                         board=str(self.board),
                         board_size=self.board_size,
-                        user_x=self.user_x.get().name,
-                        user_o=self.user_o.get().name,
-                        next_move=self.next_move.get().name,
+                        win_length=self.engine.win_length,
+                        user_x=names[self.user_x],
+                        user_o=names[self.user_o],
+                        next_move=names[self.next_move],
                         game_over=self.game_over,
                         game_cancelled=self.game_cancelled,
-                        message = message
+                        message = message,
+                        version=self.version
                         )
         if self.winner:
-            form.winner = self.winner.get().name
+            form.winner = names[self.winner]
         if self.tie:
             form.tie = self.tie
         return form
 
+    @classmethod
+    @timed_method('serialize')
+    def to_forms(cls, games, message):
+        """Returns GameForms for a result set, resolving every referenced
+        User with a single batched get"""
+        games = list(games)
+        names = get_user_names(key for game in games
+                               for key in game.user_keys)
+        return [game.to_form(message, names) for game in games]
+
+    def make_move(self, user_key, move):
+        """Plays a move for user_key, ending the game on a win or a full
+        board. Returns a message for the player. Raises ValueError if the
+        move is not allowed. A game that is still in progress afterwards
+        is not saved; the caller puts it."""
+        if self.game_over:
+            return 'Game already over!'
+        elif self.game_cancelled:
+            return 'This Game is cancelled'
+
+        letter = 'O' if self.user_o == user_key else 'X'
+        if user_key != self.next_move:
+            raise ValueError('It\'s not your turn!')
+
+        last_cell = self.board_size * self.board_size - 1
+        if not 0 <= move <= last_cell:
+            raise ValueError(
+                'It\'s out or range. Your move should be in 0 to %d' % last_cell)
+        if not self.engine.is_free(move):
+            raise ValueError('This is not a Free space to move')
+
+        won = self.play(letter, move)
+        self.next_move = self.user_x if (self.user_o == user_key) else self.user_o
+        if won:
+            self.end_game(user_key)
+            return 'You won the Game'
+        elif self.engine.is_full:
+            self.end_game(False)
+            return 'Game Tie'
+        return 'You have taken good position, let wait for the oponent'
+
+    def make_computer_move(self):
+        """Plays the computer's reply. Returns a message for the player."""
+        letter = 'O' if self.user_o == self.computer else 'X'
+        cell = ai.choose_move(self.engine, letter)
+        self.make_move(self.computer, cell)
+        if self.winner == self.computer:
+            return 'The computer won the Game'
+        elif self.tie:
+            return 'Game Tie'
+        return 'The computer played {}, your move'.format(cell)
+
+    @property
+    def result(self):
+        """'user_x', 'user_o' or 'tie' for a finished game"""
+        if self.winner:
+            return 'user_x' if self.winner == self.user_x else 'user_o'
+        return 'tie'
+
     def end_game(self, winner=None):
-        """Ends the game"""
+        """Ends the game and writes the result, unless the game is held in
+        the write-behind cache (see gamecache.py), which writes it."""
         self.game_over = True
         if winner:
             self.winner = winner
         else:
             self.tie = True
-        self.put()
-        if winner:
-            result = 'user_x' if winner == self.user_x else 'user_o'
-        else:
-            result = 'tie'
+        self._count_closed(games_finished=1, moves_finished=self.engine.moves,
+                           **{RESULT_COUNTERS[self.result]: 1})
+        if not getattr(self, '_write_behind', False):
+            self.write_result()
+
+    def write_result(self):
+        """Writes the finished game, its Score, both players (with their new
+        ratings) and their HeadToHead with a single put_multi, so inside a
+        transaction the end of a game costs one commit."""
+        winner = self.winner
         # Add the game to the score 'board'
         score = Score(date=date.today(), user_x=self.user_x,
-                      user_o=self.user_o, result=result)
-        score.put()
-
-        # Update the user models
+                      user_o=self.user_o, result=self.result)
+
+        # Update the user models and their head-to-head record
+        head_to_head_key = HeadToHead.key_for(self.user_x, self.user_o)
+        user_x, user_o, head_to_head = ndb.get_multi(
+            [self.user_x, self.user_o, head_to_head_key])
+        if not head_to_head:
+            head_to_head = HeadToHead.new(head_to_head_key, self.user_x,
+                                          self.user_o)
+        head_to_head.record(winner)
+        old_points = [user_x.totlal_points, user_o.totlal_points]
+        user_x.rating, user_o.rating = rating.update(
+            user_x.rating, user_o.rating, self.result,
+            user_x.total_played, user_o.total_played)
         if winner:
-            winner.get().add_win()
-            loser = self.user_x if winner == self.user_o else self.user_o
-            loser.get().add_loss()
+            winner_user, loser = ((user_x, user_o) if winner == self.user_x
+                                  else (user_o, user_x))
+            winner_user.add_win()
+            loser.add_loss()
         else:
-            self.user_x.get().add_tie()
-            self.user_o.get().add_tie()
+            user_x.add_tie()
+            user_o.add_tie()
+        buckets = leaderboard.update_buckets(
+            zip(old_points, [user_x.points, user_o.points]))
+        # the cached leaderboard catches up within its 60 second lifetime
+        ndb.put_multi([self, score, user_x, user_o, head_to_head] + buckets)
 
     def game_cancel(self):
         """Ends the game - if won is True, the player won. - if won is False,
         the player lost."""
         self.game_cancelled = True
-        self.put()
+        self.version += 1
+        self._count_closed(games_cancelled=1)
+        if not getattr(self, '_write_behind', False):
+            self.put()
+
+
+class ArchivedGame(ndb.Model):
+    """A finished or cancelled Game moved out of the Game kind by the
+    archive cron (see archive.py). Keyed by the id of the Game, holds only
+    what it takes to show the game again, and has no indexes."""
+    user_x = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user_o = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    computer = ndb.KeyProperty(kind='User', indexed=False)
+    board_size = ndb.IntegerProperty(required=True, indexed=False)
+    win_length = ndb.IntegerProperty(required=True, indexed=False)
+    packed_history = ndb.BlobProperty(required=True)
+    result = ndb.StringProperty(required=True, indexed=False,
+                                choices=('user_x', 'user_o', 'tie',
+                                         GAME_CANCELLED))
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    ended = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def from_game(cls, game):
+        return cls(id=game.key.id(), user_x=game.user_x, user_o=game.user_o,
+                   computer=game.computer, board_size=game.board_size,
+                   win_length=game.engine.win_length,
+                   packed_history=codec.encode_history(game.history),
+                   result=(GAME_CANCELLED if game.game_cancelled
+                           else game.result),
+                   version=game.version, ended=game.updated)
+
+    def to_game(self):
+        """Returns the archived game as a Game, read only: it is never put
+        back."""
+        history = codec.decode_history(self.packed_history)
+        cancelled = self.result == GAME_CANCELLED
+        game = Game(key=ndb.Key(Game, self.key.id()), user_x=self.user_x,
+                    user_o=self.user_o, computer=self.computer,
+                    board_size=self.board_size, win_length=self.win_length,
+                    next_move=(self.user_x if len(history) % 2 == 0
+                               else self.user_o),
+                    game_over=not cancelled, game_cancelled=cancelled,
+                    tie=self.result == 'tie', version=self.version)
+        if self.result in ('user_x', 'user_o'):
+            game.winner = getattr(self, self.result)
+        game.updated = self.ended
+        game._history = history
+        game._engine = Board.from_history(history, self.board_size,
+                                          self.win_length)
+        return game
+
+    @classmethod
+    def get_game(cls, game_key):
+        """Returns the archived Game of a Game key, or None"""
+        return cls.get_games([game_key])[0]
+
+    @classmethod
+    def get_games(cls, game_keys):
+        """get_game for many keys with one batched get"""
+        archived = ndb.get_multi([ndb.Key(cls, key.id()) for key in game_keys])
+        return [entity.to_game() if entity else None for entity in archived]
 
 
 class Score(ndb.Model):
@@ -154,12 +548,75 @@ class Score(ndb.Model):
     result = ndb.StringProperty(required=True)
     date = ndb.DateProperty(required=True)
 
-    def to_form(self):
+    @timed_method('serialize')
+    def to_form(self, names=None):
+        if names is None:
+            names = get_user_names([self.user_x, self.user_o])
         return ScoreForm(date=str(self.date),
-                         user_x=self.user_x.get().name,
-                         user_o=self.user_o.get().name,
+                         user_x=names[self.user_x],
+                         user_o=names[self.user_o],
                          result=self.result)
 
+    @classmethod
+    @timed_method('serialize')
+    def to_forms(cls, scores):
+        """Returns ScoreForms for a result set, resolving every referenced
+        User with a single batched get"""
+        scores = list(scores)
+        names = get_user_names(key for score in scores
+                               for key in (score.user_x, score.user_o))
+        return [score.to_form(names) for score in scores]
+
+
+class HeadToHead(ndb.Model):
+    """Results between two users, keyed by the pair so that it is read with
+    a single get. user_a is the lower of the two keys."""
+    user_a = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user_b = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    a_wins = ndb.IntegerProperty(default=0, indexed=False)
+    b_wins = ndb.IntegerProperty(default=0, indexed=False)
+    ties = ndb.IntegerProperty(default=0, indexed=False)
+    last_played = ndb.DateTimeProperty(indexed=False)
+
+    @staticmethod
+    def _ordered(user_key, opponent_key):
+        return sorted([user_key, opponent_key], key=lambda key: key.pairs())
+
+    @classmethod
+    def key_for(cls, user_key, opponent_key):
+        """The key of the record of two users, in either order"""
+        user_a, user_b = cls._ordered(user_key, opponent_key)
+        return ndb.Key(cls, '{}:{}'.format(user_a.id(), user_b.id()))
+
+    @classmethod
+    def new(cls, key, user_key, opponent_key):
+        user_a, user_b = cls._ordered(user_key, opponent_key)
+        return cls(key=key, user_a=user_a, user_b=user_b)
+
+    def record(self, winner):
+        """Adds a finished game. winner is a User key, or None for a tie.
+        The caller puts the record."""
+        if not winner:
+            self.ties += 1
+        elif winner == self.user_a:
+            self.a_wins += 1
+        else:
+            self.b_wins += 1
+        self.last_played = datetime.now()
+
+    @timed_method('serialize')
+    def to_form(self, user_key, names):
+        """Returns a HeadToHeadForm from the point of view of user_key"""
+        wins, losses = ((self.a_wins, self.b_wins) if user_key == self.user_a
+                        else (self.b_wins, self.a_wins))
+        opponent = self.user_b if user_key == self.user_a else self.user_a
+        return HeadToHeadForm(user=names[user_key],
+                              opponent=names[opponent],
+                              wins=wins, losses=losses, ties=self.ties,
+                              total_played=wins + losses + self.ties,
+                              last_played=(str(self.last_played)
+                                           if self.last_played else None))
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -174,15 +631,48 @@ class GameForm(messages.Message):
     tie = messages.BooleanField(9)
     game_cancelled = messages.BooleanField(10, required=True)
     message = messages.StringField(11, required=True)
+    win_length = messages.IntegerField(12)
+    version = messages.IntegerField(13)
+
+class GameStatsForm(messages.Message):
+    """Live statistics over all games"""
+    games_active = messages.IntegerField(1, required=True)
+    games_finished = messages.IntegerField(2, required=True)
+    games_cancelled = messages.IntegerField(3, required=True)
+    average_moves_played = messages.FloatField(4, required=True)
+    average_moves_remaining = messages.FloatField(5, required=True)
+    tie_rate = messages.FloatField(6, required=True)
+    x_win_rate = messages.FloatField(7, required=True)
+    o_win_rate = messages.FloatField(8, required=True)
+    first_move_advantage = messages.FloatField(9, required=True)
+
+class GamePollForm(messages.Message):
+    """Answer to a poll for changes. game is only set if modified"""
+    version = messages.IntegerField(1, required=True)
+    modified = messages.BooleanField(2, required=True)
+    game = messages.MessageField(GameForm, 3)
+
+class HintForm(messages.Message):
+    """Outcome with perfect play for the player to move, and the move
+    that gets it"""
+    outcome = messages.StringField(1, required=True)  # win, draw or loss
+    best_move = messages.IntegerField(2, required=True)
+    moves_to_end = messages.IntegerField(3, required=True)
+    next_move = messages.StringField(4, required=True)
+    message = messages.StringField(5, required=True)
 
 class  UserGameFroms(messages.Message):
     """Return multiple ScoreForms"""
     games = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_x = messages.StringField(1, required=True)
-    user_o = messages.StringField(2, required=True)
+    user_o = messages.StringField(2)
+    board_size = messages.IntegerField(3)
+    win_length = messages.IntegerField(4)
+    vs_computer = messages.BooleanField(5, default=False)
 
 
 class MakeMoveForm(messages.Message):
@@ -190,6 +680,33 @@ class MakeMoveForm(messages.Message):
     move = messages.IntegerField(1, required=True)
 
 
+class GameMoveForm(messages.Message):
+    """One move of a batch: a player's move in a game"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    user = messages.StringField(2, required=True)
+    move = messages.IntegerField(3, required=True)
+
+
+class GameMoveForms(messages.Message):
+    """Moves for many games, or a sequence for one game, applied in order"""
+    moves = messages.MessageField(GameMoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """Outcome of one move of a batch"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    move = messages.IntegerField(2, required=True)
+    ok = messages.BooleanField(3, required=True)
+    message = messages.StringField(4, required=True)
+
+
+class MoveResultForms(messages.Message):
+    """A result per submitted move, in order, and the final state of every
+    game that was found"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+    games = messages.MessageField(GameForm, 2, repeated=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_x= messages.StringField(1, required=True)
@@ -201,6 +718,17 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+class HeadToHeadForm(messages.Message):
+    """Record of a user against one opponent"""
+    user = messages.StringField(1, required=True)
+    opponent = messages.StringField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    losses = messages.IntegerField(4, required=True)
+    ties = messages.IntegerField(5, required=True)
+    total_played = messages.IntegerField(6, required=True)
+    last_played = messages.StringField(7)
 
 class UserRankingForm(messages.Message):
     """ScoreForm for outbound Score information"""
@@ -211,10 +739,14 @@ class UserRankingForm(messages.Message):
     total_played = messages.IntegerField(5, required=True)
     no_lose_percentage = messages.FloatField(6, required=True)
     points = messages.IntegerField(7)
+    rank = messages.IntegerField(8)
+    win_percentage = messages.FloatField(9)
+    rating = messages.IntegerField(10)
 
 class UserRankingForms(messages.Message):
     """Return multiple ScoreForms"""
     users = messages.MessageField(UserRankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
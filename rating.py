@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""rating.py - Elo ratings of users.
+
+Game.write_result updates both players' ratings when a game ends, in the
+same transaction as their counters. The K factor is higher while a player
+has few games, so new ratings settle quickly.
+
+Changing the parameters means replaying the whole history, which the batch
+mode does offline from a Score export (see bulk.py): scores are sorted by
+date (then id, so ties within a day replay the same way every time), users
+are mapped to dense indices and the ratings are replayed in one pass over
+flat arrays. Pass --apply HOST to write the results to the app.
+
+    python rating.py export/Score-*.ndjson.gz [--out ratings.csv]
+        [--k 20] [--provisional-k 40] [--provisional-games 20]
+        [--initial 1500] [--apply my-app.appspot.com [--sdk PATH]]"""
+
+import argparse
+import csv
+import logging
+import time
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 20
+PROVISIONAL_K_FACTOR = 40
+PROVISIONAL_GAMES = 20  # games played before K_FACTOR applies
+SCALE = 400.0
+APPLY_BATCH_SIZE = 500
+
+# Score.result -> actual score of user_x
+X_SCORES = {'user_x': 1.0, 'user_o': 0.0, 'tie': 0.5}
+
+
+class Parameters(object):
+    """Rating parameters, the module defaults unless given"""
+
+    def __init__(self, k=K_FACTOR, provisional_k=PROVISIONAL_K_FACTOR,
+                 provisional_games=PROVISIONAL_GAMES, initial=INITIAL_RATING):
+        self.k = k
+        self.provisional_k = provisional_k
+        self.provisional_games = provisional_games
+        self.initial = initial
+
+    def k_factor(self, games):
+        """K factor of a player who had played `games` games"""
+        return self.provisional_k if games < self.provisional_games \
+            else self.k
+
+
+DEFAULT = Parameters()
+
+
+def expected(rating, opponent):
+    """Expected score of a player against an opponent"""
+    return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / SCALE))
+
+
+def update(rating_x, rating_o, result, games_x=0, games_o=0,
+           parameters=DEFAULT):
+    """Returns the new (rating_x, rating_o) after a game.
+    Args:
+        result: 'user_x', 'user_o' or 'tie', as in Score.result
+        games_x, games_o: games each player had played before this one"""
+    delta = X_SCORES[result] - expected(rating_x, rating_o)
+    return (rating_x + parameters.k_factor(games_x) * delta,
+            rating_o - parameters.k_factor(games_o) * delta)
+
+
+def load_scores(paths):
+    """Reads Score exports into arrays sorted by date, then id.
+    Returns (user ids, x indices, o indices, user_x scores), the indices
+    pointing into user ids."""
+    import numpy as np
+    from analysis import read_ndjson
+    dates, ids, users_x, users_o, results = [], [], [], [], []
+    for path in paths:
+        for record in read_ndjson(path):
+            dates.append(record['date'])
+            ids.append(str(record['id']))
+            users_x.append(str(record['user_x']))
+            users_o.append(str(record['user_o']))
+            results.append(X_SCORES[record['result']])
+    order = np.lexsort((np.array(ids), np.array(dates)))
+    users, indices = np.unique(np.array(users_x + users_o),
+                               return_inverse=True)
+    count = len(dates)
+    return (users, indices[:count][order], indices[count:][order],
+            np.array(results, dtype=np.float64)[order])
+
+
+def recompute(player_count, x_indices, o_indices, x_scores,
+              parameters=DEFAULT):
+    """Replays every game in order. Returns (ratings, games played), one
+    entry per player."""
+    import numpy as np
+    ratings = [float(parameters.initial)] * player_count
+    games = [0] * player_count
+    k, provisional_k = parameters.k, parameters.provisional_k
+    provisional_games = parameters.provisional_games
+    # plain lists and locals: the replay is sequential, and indexing a
+    # list is several times faster than indexing a NumPy array
+    for x, o, score in zip(x_indices.tolist(), o_indices.tolist(),
+                           x_scores.tolist()):
+        rating_x, rating_o = ratings[x], ratings[o]
+        delta = score - 1.0 / (1.0 + 10.0 ** ((rating_o - rating_x) / SCALE))
+        ratings[x] = rating_x + (provisional_k if games[x] < provisional_games
+                                 else k) * delta
+        ratings[o] = rating_o - (provisional_k if games[o] < provisional_games
+                                 else k) * delta
+        games[x] += 1
+        games[o] += 1
+    return np.array(ratings), np.array(games)
+
+
+def write_ratings(users, ratings, games, path):
+    """Writes id, rating and games per user, highest rating first"""
+    with open(path, 'w') as out:
+        writer = csv.writer(out)
+        writer.writerow(['id', 'rating', 'games'])
+        for i in sorted(range(len(users)), key=lambda i: -ratings[i]):
+            writer.writerow([users[i], '{:.1f}'.format(ratings[i]),
+                             games[i]])
+
+
+def apply_ratings(users, ratings, parameters=DEFAULT,
+                  batch_size=APPLY_BATCH_SIZE):
+    """Writes recomputed ratings to the Users, through remote_api (see
+    bulk.connect). Users without a finished game are reset to the initial
+    rating. Games finishing meanwhile are overwritten, so run it while the
+    app is quiet."""
+    from google.appengine.ext import ndb
+    from models import User
+    by_key = dict((ndb.Key(User, int(user) if user.isdigit() else user),
+                   rating) for user, rating in zip(users, ratings))
+    batch = []
+    for user in User.query():
+        user.rating = float(by_key.get(user.key, parameters.initial))
+        batch.append(user)
+        if len(batch) >= batch_size:
+            ndb.put_multi(batch)
+            batch = []
+    if batch:
+        ndb.put_multi(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recompute every rating from a Score export')
+    parser.add_argument('scores', nargs='+', help='Score NDJSON exports')
+    parser.add_argument('--out', default='ratings.csv')
+    parser.add_argument('--k', type=float, default=K_FACTOR)
+    parser.add_argument('--provisional-k', type=float,
+                        default=PROVISIONAL_K_FACTOR)
+    parser.add_argument('--provisional-games', type=int,
+                        default=PROVISIONAL_GAMES)
+    parser.add_argument('--initial', type=float, default=INITIAL_RATING)
+    parser.add_argument('--apply', metavar='HOST',
+                        help='write the ratings to the app at HOST')
+    parser.add_argument('--sdk', help='path to the google_appengine SDK')
+    args = parser.parse_args()
+    parameters = Parameters(args.k, args.provisional_k,
+                            args.provisional_games, args.initial)
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    users, x_indices, o_indices, x_scores = load_scores(args.scores)
+    loaded = time.time()
+    ratings, games = recompute(len(users), x_indices, o_indices, x_scores,
+                               parameters)
+    logging.info('%d games of %d users loaded in %.1fs, rated in %.1fs',
+                 len(x_scores), len(users), loaded - start,
+                 time.time() - loaded)
+    write_ratings(users, ratings, games, args.out)
+    if args.apply:
+        from bulk import connect
+        connect(args.apply, args.sdk)
+        apply_ratings(users, ratings, parameters)
+
+
+if __name__ == '__main__':
+    main()
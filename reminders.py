@@ -0,0 +1,162 @@
+"""reminders.py - Cursor-driven fan-out for the reminder email crons.
+
+A cron run starts a chain of page tasks. Each page task reads one page of
+games, batch-fetches their players, drops players already reminded in this
+run and enqueues the mail sends in batches, then enqueues the next page.
+Tasks are named after the run and page, so a page task that is retried
+after a deadline or failure resumes from its own cursor without enqueueing
+its mails twice. The throughput counters of the latest runs are served
+by /admin/stats."""
+
+import json
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Game
+from models import GAME_ACTIVE
+from models import GAME_CANCELLED
+from utils import fetch_page
+
+PAGE_SIZE = 100
+MAIL_BATCH_SIZE = 50
+MAIL_QUEUE = 'mail'
+DEDUPE_TIMEOUT = 24 * 60 * 60
+STATS_KEY = 'reminders:{}:{}'
+RUN_COUNTERS = ('pages', 'games', 'recipients', 'mails')
+RUNS_KEY = 'reminders:runs'
+RECENT_RUNS = 10  # runs listed by get_recent_stats
+CAS_RETRIES = 5
+
+REMINDERS = {
+    'active': {
+        'query': lambda: Game.query(Game.status == GAME_ACTIVE),
+        'subject': 'This is a reminder!',
+        'body': 'Hello {}, finish the game',
+    },
+    'cancelled': {
+        'query': lambda: Game.query(Game.status == GAME_CANCELLED),
+        'subject': 'This is a reminder!',
+        'body': 'Hello {}, try out Guess A Number!',
+    },
+}
+
+
+def start(reminder):
+    """Starts a reminder run by enqueueing its first page task"""
+    run_id = '{}-{}'.format(reminder, int(time.time()))
+    _enqueue_page(reminder, run_id, 0, None)
+    _list_run(run_id)
+    return run_id
+
+
+def _list_run(run_id):
+    """Adds a run to the latest runs, newest first"""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        runs = client.gets(RUNS_KEY)
+        if runs is None:
+            if client.add(RUNS_KEY, [run_id]):
+                return
+        elif client.cas(RUNS_KEY, ([run_id] + runs)[:RECENT_RUNS]):
+            return
+    logging.warning('Could not list reminder run %s', run_id)
+
+
+def _enqueue_page(reminder, run_id, page, cursor):
+    params = {'reminder': reminder, 'run_id': run_id, 'page': page}
+    if cursor:
+        params['cursor'] = cursor
+    _add([taskqueue.Task(url='/tasks/reminders/page', params=params,
+                         name='{}-page-{}'.format(run_id, page))])
+
+
+def _add(tasks, queue_name='default'):
+    """Adds named tasks, ignoring the ones a previous attempt already added"""
+    try:
+        taskqueue.Queue(queue_name).add(tasks)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        for task in tasks:
+            try:
+                taskqueue.Queue(queue_name).add(task)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                pass
+
+
+def process_page(reminder, run_id, page, cursor=None):
+    """Reminds the players of one page of games and chains the next page"""
+    config = REMINDERS[reminder]
+    games, next_cursor = fetch_page(config['query'](), PAGE_SIZE, cursor,
+                                    projection=[Game.user_x, Game.user_o])
+    if next_cursor:
+        _enqueue_page(reminder, run_id, page + 1, next_cursor)
+
+    user_keys = set()
+    for game in games:
+        user_keys.update([game.user_x, game.user_o])
+    users = [user for user in ndb.get_multi(list(user_keys))
+             if user and user.email]
+
+    # memcache.add only succeeds for the first page that sees a user. The
+    # page number is stored so a retry of the same page keeps its users.
+    dedupe = dict(('reminded:{}:{}'.format(run_id, user.key.id()), user)
+                  for user in users)
+    taken = memcache.add_multi(dict.fromkeys(dedupe, page),
+                               time=DEDUPE_TIMEOUT) or []
+    owners = memcache.get_multi(taken) if taken else {}
+    recipients = [(user.email, user.name) for key, user in dedupe.items()
+                  if key not in owners or owners[key] == page]
+
+    tasks = []
+    for i in range(0, len(recipients), MAIL_BATCH_SIZE):
+        batch = recipients[i:i + MAIL_BATCH_SIZE]
+        tasks.append(taskqueue.Task(
+            url='/tasks/reminders/send',
+            params={'reminder': reminder, 'run_id': run_id,
+                    'recipients': json.dumps(batch)},
+            name='{}-mail-{}-{}'.format(run_id, page, i // MAIL_BATCH_SIZE)))
+    if tasks:
+        _add(tasks, MAIL_QUEUE)
+
+    memcache.offset_multi({'games': len(games),
+                           'recipients': len(recipients),
+                           'pages': 1},
+                          key_prefix=STATS_KEY.format(run_id, ''),
+                          initial_value=0)
+    logging.info('Reminder run %s page %d: %d games, %d recipients',
+                 run_id, page, len(games), len(recipients))
+
+
+def send_batch(reminder, run_id, recipients):
+    """Sends one batch of reminder mails"""
+    # only the mail tasks need these, so other requests don't import them
+    from google.appengine.api import app_identity
+    from google.appengine.api import mail
+    config = REMINDERS[reminder]
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    for email, name in recipients:
+        mail.send_mail(sender, email, config['subject'],
+                       config['body'].format(name))
+    sent = memcache.offset_multi({'mails': len(recipients)},
+                                 key_prefix=STATS_KEY.format(run_id, ''),
+                                 initial_value=0)
+    logging.info('Reminder run %s: %d mails sent so far', run_id,
+                 sent.get('mails') or 0)
+
+
+def get_recent_stats():
+    """Returns the throughput counters of the latest runs, newest first, as
+    a list of dicts with the run id, in two memcache calls"""
+    runs = memcache.get(RUNS_KEY) or []
+    counts = memcache.get_multi([STATS_KEY.format(run_id, counter)
+                                 for run_id in runs
+                                 for counter in RUN_COUNTERS])
+    return [dict([('run_id', run_id)] +
+                 [(counter, counts.get(STATS_KEY.format(run_id, counter), 0))
+                  for counter in RUN_COUNTERS])
+            for run_id in runs]
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""solver.py - Solved-position tables for small boards.
+
+The generator plays out every position reachable from the empty board,
+folding the 8 rotations and reflections together as ai.canonical does, and
+writes one sorted binary table per board: a header followed by fixed-width
+records of canonical position -> value, best move and moves to the end,
+from the point of view of the player to move. The key of a position is its
+X bitboard shifted above its O bitboard, so sorting by key is sorting by
+the canonical form.
+
+Tables are memory-mapped where the runtime allows (and otherwise read once
+into a single string), and looked up by binary search directly in the
+buffer, so loading a table costs no parsing.
+
+    python solver.py --size 3 [--win-length 3] [--out solved]"""
+
+import argparse
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+from ai import symmetries
+from engine import DIRECTIONS
+from engine import default_win_length
+
+TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'solved')
+MAX_SIZE = 4  # both bitboards of a position have to fit the 32 bit key
+TABLE_NAME = re.compile(r'(\d+)x\1-(\d+)\.bin$')  # as table_path()
+MAGIC = b'TTTS'
+HEADER = struct.Struct('<4sBBI')  # magic, size, win length, records
+RECORD = struct.Struct('<IbBB')  # key, value, best cell, moves to the end
+
+WIN, DRAW, LOSS = 1, 0, -1
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def table_path(size, win_length=None):
+    return os.path.join(TABLE_DIR, '{0}x{0}-{1}.bin'.format(
+        size, win_length or default_win_length(size)))
+
+
+def position_key(x_bits, o_bits, cells):
+    return x_bits << cells | o_bits
+
+
+def _win_masks(size, win_length):
+    """Bit masks of every winning line through each cell"""
+    masks = [[] for _ in range(size * size)]
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in DIRECTIONS:
+                end_row = row + d_row * (win_length - 1)
+                end_col = col + d_col * (win_length - 1)
+                if 0 <= end_row < size and 0 <= end_col < size:
+                    cells = [(row + d_row * i) * size + col + d_col * i
+                             for i in range(win_length)]
+                    mask = sum(1 << cell for cell in cells)
+                    for cell in cells:
+                        masks[cell].append(mask)
+    return masks
+
+
+class _Solver(object):
+    """Negamax over every reachable position, memoized by canonical key"""
+
+    def __init__(self, size, win_length):
+        self.size = size
+        self.win_length = win_length
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        self.masks = _win_masks(size, win_length)
+        self.perms = symmetries(size)
+        # per symmetry and byte of a bitboard: that byte's cells, permuted
+        self.byte_tables = []
+        for perm in self.perms:
+            tables = []
+            for shift in range(0, self.cells, 8):
+                table = []
+                for byte in range(256):
+                    bits = 0
+                    for bit in range(8):
+                        if byte >> bit & 1 and shift + bit < self.cells:
+                            bits |= 1 << perm[shift + bit]
+                    table.append(bits)
+                tables.append((shift, table))
+            self.byte_tables.append(tables)
+        self.solved = {}  # canonical key -> (value, best canonical cell, plies)
+
+    def _permute(self, bits, tables):
+        result = 0
+        for shift, table in tables:
+            result |= table[bits >> shift & 255]
+        return result
+
+    def canonical(self, x_bits, o_bits):
+        """Returns (key, index of the symmetry that produces it)"""
+        best = None
+        for index, tables in enumerate(self.byte_tables):
+            key = position_key(self._permute(x_bits, tables),
+                               self._permute(o_bits, tables), self.cells)
+            if best is None or key < best[0]:
+                best = (key, index)
+        return best
+
+    def solve(self, mover, waiting):
+        """Solves the position with `mover` to play. Returns (value, best
+        cell on this board, plies to the end)."""
+        x_bits, o_bits = ((mover, waiting)
+                          if bin(mover).count('1') == bin(waiting).count('1')
+                          else (waiting, mover))
+        key, index = self.canonical(x_bits, o_bits)
+        entry = self.solved.get(key)
+        perm = self.perms[index]
+        if entry is not None:
+            value, best, plies = entry
+            return value, perm.index(best), plies
+
+        best_result = None
+        free = self.full & ~(mover | waiting)
+        while free:
+            low = free & -free
+            free ^= low
+            cell = low.bit_length() - 1
+            played = mover | low
+            if any(played & mask == mask for mask in self.masks[cell]):
+                result = (WIN, 1)
+            elif played | waiting == self.full:
+                result = (DRAW, 1)
+            else:
+                value, _, plies = self.solve(waiting, played)
+                result = (-value, plies + 1)
+            if best_result is None or _better(result, best_result[0]):
+                best_result = (result, cell)
+        (value, plies), cell = best_result
+        self.solved[key] = (value, perm[cell], plies)
+        return value, cell, plies
+
+
+def _better(a, b):
+    """Orders (value, plies) results: win fastest, lose slowest"""
+    if a[0] != b[0]:
+        return a[0] > b[0]
+    if a[0] == WIN:
+        return a[1] < b[1]
+    if a[0] == LOSS:
+        return a[1] > b[1]
+    return False
+
+
+def generate(size, win_length=None, path=None):
+    """Solves a board and writes its table. Returns the number of records."""
+    win_length = win_length or default_win_length(size)
+    if size > MAX_SIZE:
+        raise ValueError('Boards up to {0}x{0} can be solved'.format(MAX_SIZE))
+    solver = _Solver(size, win_length)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, solver.cells * 4 + 100))
+    try:
+        solver.solve(0, 0)
+    finally:
+        sys.setrecursionlimit(limit)
+    path = path or table_path(size, win_length)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.tmp', 'wb') as out:
+        out.write(HEADER.pack(MAGIC, size, win_length, len(solver.solved)))
+        for key in sorted(solver.solved):
+            value, best, plies = solver.solved[key]
+            out.write(RECORD.pack(key, value, best, plies))
+    os.rename(path + '.tmp', path)
+    return len(solver.solved)
+
+
+class SolvedTable(object):
+    """A table written by generate(), searched in place"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as table:
+            try:
+                import mmap
+                self.buffer = mmap.mmap(table.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            except (ImportError, EnvironmentError, ValueError):
+                self.buffer = table.read()
+        magic, self.size, self.win_length, self.count = HEADER.unpack_from(
+            self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a solved-position table'.format(path))
+        self.cells = self.size * self.size
+        self.perms = symmetries(self.size)
+
+    def _find(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = RECORD.unpack_from(
+                self.buffer, HEADER.size + middle * RECORD.size)
+            if record[0] < key:
+                low = middle + 1
+            elif record[0] > key:
+                high = middle
+            else:
+                return record
+        return None
+
+    def lookup(self, board):
+        """Returns (value, best cell, moves to the end) for the player to
+        move on an engine.Board, or None if the position isn't in the table
+        (the game is over, or the board wasn't reached by alternate play)"""
+        best = None
+        for perm in self.perms:
+            key = position_key(_permute(board.stones['X'], perm),
+                               _permute(board.stones['O'], perm), self.cells)
+            if best is None or key < best[0]:
+                best = (key, perm)
+        key, perm = best
+        record = self._find(key)
+        if record is None:
+            return None
+        _, value, cell, plies = record
+        return value, perm.index(cell), plies
+
+
+def _permute(bits, perm):
+    result = 0
+    while bits:
+        low = bits & -bits
+        result |= 1 << perm[low.bit_length() - 1]
+        bits ^= low
+    return result
+
+
+def get_table(size, win_length=None):
+    """Returns the table of a board, loaded once per instance, or None if
+    no table was generated for it"""
+    key = (size, win_length or default_win_length(size))
+    if key not in _tables:
+        with _tables_lock:
+            if key not in _tables:
+                path = table_path(*key)
+                _tables[key] = SolvedTable(path) if os.path.exists(path) \
+                    else None
+    return _tables[key]
+
+
+def load_tables():
+    """Loads every table under TABLE_DIR. Returns them."""
+    tables = []
+    if os.path.isdir(TABLE_DIR):
+        for name in sorted(os.listdir(TABLE_DIR)):
+            match = TABLE_NAME.match(name)
+            if match:
+                tables.append(get_table(int(match.group(1)),
+                                        int(match.group(2))))
+    return tables
+
+
+def evaluate(board):
+    """lookup() on the table of the board's size, None without a table"""
+    table = get_table(board.size, board.win_length)
+    return table.lookup(board) if table else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a solved-position table')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--win-length', type=int)
+    parser.add_argument('--out', help='table file, under solved/ by default')
+    args = parser.parse_args()
+    start = time.time()
+    count = generate(args.size, args.win_length, args.out)
+    print('{} positions solved in {:.1f}s'.format(count, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
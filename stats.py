@@ -0,0 +1,114 @@
+"""stats.py - Live game statistics kept in sharded counters.
+
+Games record counter deltas as they are created, moved, finished and
+cancelled (see Game._pre_put_hook). The deltas are written to one random
+StatsShard in the same transaction as the game, and added to the memcache
+copy of the counters once that transaction commits. Games held in the
+write-behind cache queue their deltas instead, and gamecache.py records
+the sum of every game it writes as one update. Reads are served from
+memcache; only after an eviction are the shards summed again, which never
+needs a scan of the Game kind.
+
+The counters only see games that change after they were deployed, and
+games that were active before then would take the active counters below
+zero when they end. migrations.seed_game_stats counts every existing game
+once, in batches, after reset() clears the shards."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+MEMCACHE_PREFIX = 'stats:'
+MEMCACHE_TIMEOUT = 10 * 60  # bounds drift between memcache and the shards
+
+COUNTERS = (
+    'games_created',
+    'games_active',
+    'games_finished',
+    'games_cancelled',
+    'cells_active',     # board cells of all active games
+    'moves_active',     # moves played in all active games
+    'moves_finished',   # moves played in all finished games
+    'x_wins',
+    'o_wins',
+    'ties',
+)
+
+
+class StatsShard(ndb.Model):
+    """One shard of every game counter"""
+    counts = ndb.JsonProperty(default={})
+
+
+@ndb.transactional(propagation=ndb.TransactionOptions.ALLOWED)
+def record(deltas):
+    """Adds counter deltas to a random shard, joining the current
+    transaction if there is one"""
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    key = ndb.Key(StatsShard, str(random.randint(0, NUM_SHARDS - 1)))
+    shard = key.get() or StatsShard(key=key, counts={})
+    counts = dict(shard.counts)
+    for name, delta in deltas.items():
+        counts[name] = counts.get(name, 0) + delta
+    shard.counts = counts
+    shard.put()
+
+    def update_memcache():
+        # offset_multi only changes counters that are cached; missing ones
+        # are rebuilt from the shards by get_counts
+        memcache.offset_multi(
+            dict((name, delta) for name, delta in deltas.items()),
+            key_prefix=MEMCACHE_PREFIX)
+    ndb.get_context().call_on_commit(update_memcache)
+
+
+def reset():
+    """Deletes every shard and the cached counters"""
+    ndb.delete_multi(StatsShard.query().fetch(keys_only=True))
+    memcache.delete_multi(COUNTERS, key_prefix=MEMCACHE_PREFIX)
+
+
+def get_counts():
+    """Returns every counter, from memcache where possible"""
+    counts = memcache.get_multi(COUNTERS, key_prefix=MEMCACHE_PREFIX)
+    if len(counts) < len(COUNTERS):
+        totals = dict.fromkeys(COUNTERS, 0)
+        for shard in StatsShard.query():
+            for name, count in shard.counts.items():
+                if name in totals:
+                    totals[name] += count
+        missing = dict((name, count) for name, count in totals.items()
+                       if name not in counts)
+        memcache.add_multi(missing, key_prefix=MEMCACHE_PREFIX,
+                           time=MEMCACHE_TIMEOUT)
+        counts.update(missing)
+    return counts
+
+
+def _ratio(numerator, denominator):
+    return float(numerator) / denominator if denominator else 0.0
+
+
+def get_summary():
+    """Returns the derived statistics as a dict"""
+    counts = get_counts()
+    finished = counts['games_finished']
+    active = counts['games_active']
+    return {
+        'games_active': active,
+        'games_finished': finished,
+        'games_cancelled': counts['games_cancelled'],
+        'average_moves_played': _ratio(counts['moves_finished'], finished),
+        'average_moves_remaining': _ratio(
+            counts['cells_active'] - counts['moves_active'], active),
+        'tie_rate': _ratio(counts['ties'], finished),
+        'x_win_rate': _ratio(counts['x_wins'], finished),
+        'o_win_rate': _ratio(counts['o_wins'], finished),
+        # share of decisive games won by the player who moved first
+        'first_move_advantage': _ratio(counts['x_wins'],
+                                       counts['x_wins'] + counts['o_wins']),
+    }
@@ -0,0 +1,26 @@
+"""helpers.py - Shared by the tests: puts the app on the path and plays
+random positions."""
+
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+from engine import Board
+from engine import O
+from engine import X
+
+
+def random_position(rng, size, win_length, moves):
+    """Plays up to moves random moves; returns the board and its history"""
+    board = Board(size, win_length)
+    history = []
+    for i in range(moves):
+        if board.is_over:
+            break
+        letter = X if i % 2 == 0 else O
+        cell = rng.choice(list(board.free_cells()))
+        board.play(cell, letter)
+        history.append((letter, cell))
+    return board, history
@@ -0,0 +1,61 @@
+"""test_ai.py - Tests of the computer opponent."""
+
+import random
+import unittest
+
+from helpers import random_position  # puts the app on the path
+
+import ai
+from engine import Board
+from engine import O
+from engine import X
+from engine import other
+
+
+class AiTest(unittest.TestCase):
+
+    def test_takes_a_win(self):
+        board = Board.from_history([(X, 0), (O, 3), (X, 1), (O, 4)])
+        self.assertEqual(ai.choose_move(board, X), 2)
+
+    def test_blocks_a_win(self):
+        board = Board.from_history([(X, 0), (O, 4), (X, 1)])
+        self.assertEqual(ai.choose_move(board, O), 2)
+
+    def test_blocks_on_a_large_board(self):
+        history = [(X, 112), (O, 111), (X, 113), (O, 0), (X, 114), (O, 14),
+                   (X, 115)]
+        board = Board.from_history(history, 15)
+        self.assertEqual(ai.choose_move(board, O), 116)
+
+    def test_never_loses_on_3x3(self):
+        rng = random.Random(5)
+        for _ in range(20):
+            board = Board(3)
+            letter = X
+            while not board.is_over:
+                if letter == O:
+                    cell = ai.choose_move(board, O)
+                else:
+                    cell = rng.choice(list(board.free_cells()))
+                board.play(cell, letter)
+                letter = other(letter)
+            self.assertNotEqual(board.winner, X)
+
+    def test_canonical_is_symmetric(self):
+        rng = random.Random(6)
+        perms = ai.symmetries(4)
+        for _ in range(100):
+            board, _ = random_position(rng, 4, None, rng.randint(0, 10))
+            for perm in perms:
+                moved = Board(4)
+                for letter in (X, O):
+                    for cell in range(16):
+                        if board.stones[letter] >> cell & 1:
+                            moved._place(perm[cell], letter)
+                self.assertEqual(ai.canonical(moved)[0],
+                                 ai.canonical(board)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""test_codec.py - Tests of the packed board and history encoding."""
+
+import random
+import unittest
+
+from helpers import random_position  # puts the app on the path
+
+import codec
+from engine import Board
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_board_round_trip(self):
+        rng = random.Random(3)
+        for _ in range(500):
+            size = rng.randint(3, 15)
+            board, _ = random_position(rng, size, None,
+                                       rng.randint(0, size * size))
+            data = codec.encode_board(board)
+            self.assertEqual(len(data), (board.cells + 3) // 4)
+            decoded = codec.decode_board(data, size)
+            self.assertEqual(decoded.stones, board.stones)
+            self.assertEqual(decoded.winner, board.winner)
+
+    def test_history_round_trip(self):
+        rng = random.Random(4)
+        for _ in range(200):
+            _, history = random_position(rng, 15, None, rng.randint(0, 225))
+            data = codec.encode_history(history)
+            self.assertEqual(len(data), len(history))
+            self.assertEqual(codec.decode_history(data), history)
+
+    def test_sizes(self):
+        self.assertEqual(len(codec.encode_board(Board(3))), 3)
+        self.assertEqual(len(codec.encode_board(Board(15))), 57)
+
+
+if __name__ == '__main__':
+    unittest.main()
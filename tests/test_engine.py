@@ -0,0 +1,91 @@
+"""test_engine.py - Tests of the bitboard engine, against a plain scan of
+every line. Like the other tests of pure modules they need neither the App
+Engine SDK nor NumPy, and run on Python 2 and 3:
+
+    python -m unittest discover tests
+    python -m pytest tests"""
+
+import random
+import unittest
+
+from helpers import random_position  # puts the app on the path
+
+from engine import Board
+from engine import DIRECTIONS
+from engine import O
+from engine import X
+from engine import other
+
+
+def naive_winner(cells, size, win_length):
+    """Scans every line of a list-of-letters board for win_length in a row"""
+    for row in range(size):
+        for col in range(size):
+            letter = cells[row * size + col]
+            if not letter:
+                continue
+            for d_row, d_col in DIRECTIONS:
+                end_row = row + d_row * (win_length - 1)
+                end_col = col + d_col * (win_length - 1)
+                if (0 <= end_row < size and 0 <= end_col < size and
+                        all(cells[(row + d_row * i) * size + col + d_col * i]
+                            == letter for i in range(win_length))):
+                    return letter
+    return None
+
+
+class EngineTest(unittest.TestCase):
+
+    def test_wins_match_naive_scan(self):
+        rng = random.Random(1)
+        for _ in range(3000):
+            size = rng.randint(3, 8)
+            win_length = rng.randint(3, min(size, 5))
+            board = Board(size, win_length)
+            cells = [''] * board.cells
+            letter = X
+            while not board.is_over:
+                cell = rng.choice(list(board.free_cells()))
+                won = board.play(cell, letter)
+                cells[cell] = letter
+                self.assertEqual(won, naive_winner(cells, size,
+                                                   win_length) == letter)
+                letter = other(letter)
+            self.assertEqual(board.winner, naive_winner(cells, size,
+                                                        win_length))
+            self.assertEqual(board.to_cells(), cells)
+
+    def test_undo_restores_the_board(self):
+        rng = random.Random(2)
+        for _ in range(200):
+            board, _ = random_position(rng, 5, 4, rng.randint(0, 12))
+            if board.is_over:
+                continue
+            before = board.copy()
+            letter = X if board.moves % 2 == 0 else O
+            cell = rng.choice(list(board.free_cells()))
+            board.play(cell, letter)
+            board.undo(cell, letter)
+            self.assertEqual(board.stones, before.stones)
+            self.assertEqual(board._counts, before._counts)
+            self.assertEqual(board.moves, before.moves)
+            self.assertIsNone(board.winner)
+
+    def test_illegal_moves(self):
+        board = Board(3)
+        board.play(4, X)
+        self.assertRaises(ValueError, board.play, 4, O)
+        self.assertRaises(ValueError, board.play, 9, O)
+        for cell in (0, 1, 2):
+            board.play(cell, O)
+        self.assertRaises(ValueError, board.play, 5, X)
+
+    def test_board_limits(self):
+        self.assertRaises(ValueError, Board, 2)
+        self.assertRaises(ValueError, Board, 16)
+        self.assertRaises(ValueError, Board, 5, 6)
+        self.assertEqual(Board(15).win_length, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""test_gamecache.py - Tests of the write-behind game cache against the App
+Engine testbed datastore and memcache stubs. They need the SDK and are
+skipped without it:
+
+    APPENGINE_SDK=path/to/google_appengine python -m unittest discover tests"""
+
+import os
+import sys
+import unittest
+
+from helpers import ROOT  # puts the app on the path
+
+
+def setup_sdk():
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+        sys.path.insert(0, ROOT)
+
+
+try:
+    setup_sdk()
+    from google.appengine.api import datastore_errors
+    from google.appengine.api import memcache
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+except ImportError:
+    testbed = None
+else:
+    import gamecache
+    import stats
+    from models import Game
+    from models import Score
+    from models import User
+
+# X takes the top row
+X_WINS = [(0, 'x'), (3, 'o'), (1, 'x'), (4, 'o'), (2, 'x')]
+
+
+@unittest.skipIf(testbed is None,
+                 'needs the App Engine SDK, set APPENGINE_SDK')
+class GameCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        context = ndb.get_context()
+        context.set_cache_policy(False)
+        context.set_memcache_policy(False)
+        self.users = {'x': User.create('player_x').key,
+                      'o': User.create('player_o').key}
+        self.write = gamecache._write
+
+    def tearDown(self):
+        gamecache._write = self.write
+        self.testbed.deactivate()
+
+    def new_game(self):
+        game = Game.new_game(self.users['x'], self.users['o'])
+        gamecache.prime(game)
+        return game.key
+
+    def moves(self, moves):
+        return [(self.users[player], cell) for cell, player in moves]
+
+    def cached(self, key):
+        return memcache.get(gamecache.GAME_PREFIX + key.urlsafe())
+
+    def counts(self):
+        memcache.delete_multi(stats.COUNTERS, key_prefix=stats.MEMCACHE_PREFIX)
+        return stats.get_counts()
+
+    def fail_writes(self):
+        attempts = []
+
+        def write(game):
+            attempts.append(game.key)
+            future = ndb.Future()
+            future.set_exception(
+                datastore_errors.TransactionFailedError('unavailable'))
+            return future
+        gamecache._write = write
+        return attempts
+
+    def test_move_stays_in_the_cache_until_the_flush(self):
+        key = self.new_game()
+        game, results = gamecache.play(key, self.moves([(4, 'x')]))
+        self.assertEqual(results, [
+            (True, 'You have taken good position, let wait for the oponent')])
+        self.assertEqual(game.version, 1)
+        self.assertEqual(key.get().version, 0)
+        self.assertEqual(gamecache.get(key).version, 1)
+        self.assertIsNotNone(self.cached(key)['dirty_since'])
+
+        self.assertEqual(gamecache.flush(), 1)
+        self.assertEqual(key.get().version, 1)
+        self.assertEqual(key.get().history, [('X', 4)])
+        self.assertIsNone(self.cached(key)['dirty_since'])
+        self.assertEqual(gamecache.flush(), 0)
+
+    def test_invalid_moves_are_reported_per_move(self):
+        key = self.new_game()
+        _, results = gamecache.play(key, self.moves(
+            [(4, 'o'), (4, 'x'), (4, 'o'), (9, 'o'), (0, 'o')]))
+        self.assertEqual([ok for ok, _ in results],
+                         [False, True, False, False, True])
+        self.assertEqual(gamecache.get(key).history, [('X', 4), ('O', 0)])
+
+    def test_play_multi(self):
+        keys = [self.new_game(), self.new_game()]
+        missing = ndb.Key(Game, 12345)
+        played, failed = gamecache.play_multi({
+            keys[0]: self.moves([(0, 'x'), (1, 'o')]),
+            keys[1]: self.moves(X_WINS),
+            missing: self.moves([(0, 'x')])})
+        self.assertEqual(failed, {})
+        self.assertEqual(played[keys[0]][0].history, [('X', 0), ('O', 1)])
+        self.assertEqual(played[missing], (None, [(False, 'Game not found!')]))
+        # the finished game is written through with its result
+        finished = keys[1].get()
+        self.assertTrue(finished.game_over)
+        self.assertEqual(finished.winner, self.users['x'])
+        self.assertIsNone(self.cached(keys[1]))
+        self.assertEqual(Score.query().count(), 1)
+        self.assertEqual(gamecache.flush(), 1)
+        self.assertEqual(keys[0].get().version, 2)
+
+    def test_cancel_is_written_through(self):
+        key = self.new_game()
+        gamecache.play(key, self.moves([(4, 'x')]))
+        game = gamecache.cancel(key)
+        self.assertTrue(game.game_cancelled)
+        stored = key.get()
+        self.assertTrue(stored.game_cancelled)
+        self.assertEqual(stored.history, [('X', 4)])
+        self.assertIsNone(self.cached(key))
+        self.assertEqual(gamecache.flush(), 0)
+        _, results = gamecache.play(key, self.moves([(0, 'o')]))
+        self.assertEqual(results, [(False, 'This Game is cancelled')])
+
+    def test_flush_after_an_eviction(self):
+        key = self.new_game()
+        game, _ = gamecache.play(key, self.moves([(4, 'x')]))
+        game.publish_version()
+        memcache.delete(gamecache.GAME_PREFIX + key.urlsafe())
+        # the moves since the last write are lost, nothing is written
+        self.assertEqual(gamecache.flush(), 0)
+        self.assertEqual(key.get().version, 0)
+        # the next move rebuilds the game past the published version
+        game, results = gamecache.play(key, self.moves([(0, 'x')]))
+        self.assertTrue(results[0][0])
+        self.assertEqual(game.history, [('X', 0)])
+        self.assertEqual(game.version, 3)
+        self.assertEqual(gamecache.flush(), 1)
+        self.assertEqual(key.get().version, 3)
+
+    def test_final_write_is_retried_and_reported(self):
+        key = self.new_game()
+        attempts = self.fail_writes()
+        self.assertRaises(datastore_errors.TransactionFailedError,
+                          gamecache.play, key, self.moves(X_WINS))
+        self.assertGreaterEqual(len(attempts),
+                                gamecache.FINAL_WRITE_RETRIES)
+        self.assertFalse(key.get().game_over)
+        self.assertTrue(self.cached(key)['game'].game_over)
+        self.assertRaises(datastore_errors.TransactionFailedError,
+                          gamecache.cancel, key)
+
+        # the ended game is written by the next request that touches it
+        gamecache._write = self.write
+        game, results = gamecache.play(key, self.moves([(5, 'o')]))
+        self.assertEqual(results, [(False, 'Game already over!')])
+        self.assertTrue(key.get().game_over)
+        self.assertIsNone(self.cached(key))
+        self.assertEqual(Score.query().count(), 1)
+
+    def test_counters_after_a_flush_and_a_write_through_race(self):
+        key = self.new_game()
+        gamecache.play(key, self.moves([(4, 'x')]))
+        client = memcache.Client()
+        racing = client.gets(gamecache.GAME_PREFIX + key.urlsafe())
+        self.assertEqual(gamecache.flush(), 1)
+        # a write-through of the same version finds the datastore up to date
+        gamecache._write_through(client, racing)
+        self.assertEqual(self.cached(key)['stats'], {})
+
+        gamecache.play(key, self.moves([(0, 'o')]))
+        gamecache.flush()
+        counts = self.counts()
+        self.assertEqual(counts['games_active'], 1)
+        self.assertEqual(counts['cells_active'], 9)
+        self.assertEqual(counts['moves_active'], 2)
+
+        gamecache.play(key, self.moves([(1, 'x'), (3, 'o'), (7, 'x')]))
+        counts = self.counts()
+        self.assertEqual(counts['games_active'], 0)
+        self.assertEqual(counts['games_finished'], 1)
+        self.assertEqual(counts['moves_active'], 0)
+        self.assertEqual(counts['moves_finished'], 5)
+        self.assertEqual(counts['x_wins'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
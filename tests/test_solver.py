@@ -0,0 +1,98 @@
+"""test_solver.py - Tests of the solved-position tables, against the
+checked-in 3x3 table and plain minimax."""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from helpers import random_position  # puts the app on the path
+
+import solver
+from engine import Board
+from engine import O
+from engine import X
+from engine import other
+
+
+def minimax(board, letter, memo):
+    """(value, plies) for letter to move, by plain search of every move:
+    the fastest win, else a draw, else the slowest loss"""
+    key = (board.stones[X], board.stones[O])
+    if key in memo:
+        return memo[key]
+    best = None
+    for cell in list(board.free_cells()):
+        if board.play(cell, letter):
+            result = (solver.WIN, 1)
+        elif board.is_full:
+            result = (solver.DRAW, 1)
+        else:
+            value, plies = minimax(board, other(letter), memo)
+            result = (-value, plies + 1)
+        board.undo(cell, letter)
+        if best is None or _rank(result) > _rank(best):
+            best = result
+    memo[key] = best
+    return best
+
+
+def _rank(result):
+    value, plies = result
+    return value, -plies if value == solver.WIN else plies
+
+
+class SolverTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, '3x3-3.bin')
+        cls.records = solver.generate(3, path=cls.path)
+        cls.table = solver.SolvedTable(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.table = None
+        shutil.rmtree(cls.directory)
+
+    def test_matches_the_checked_in_table(self):
+        self.assertEqual(self.records, 627)
+        with open(self.path, 'rb') as generated:
+            with open(solver.table_path(3), 'rb') as checked_in:
+                self.assertEqual(generated.read(), checked_in.read())
+
+    def test_matches_minimax(self):
+        rng = random.Random(7)
+        memo = {}
+        checked = 0
+        while checked < 279:
+            board, _ = random_position(rng, 3, 3, rng.randint(0, 8))
+            if board.is_over:
+                continue
+            letter = X if board.moves % 2 == 0 else O
+            value, cell, plies = self.table.lookup(board)
+            self.assertEqual((value, plies), minimax(board, letter, memo))
+            # the best cell reaches that result
+            if board.play(cell, letter):
+                result = (solver.WIN, 1)
+            elif board.is_full:
+                result = (solver.DRAW, 1)
+            else:
+                child = minimax(board, other(letter), memo)
+                result = (-child[0], child[1] + 1)
+            self.assertEqual(result, (value, plies))
+            checked += 1
+
+    def test_empty_board_is_a_draw(self):
+        value, _, plies = self.table.lookup(Board(3))
+        self.assertEqual((value, plies), (solver.DRAW, 9))
+
+    def test_finished_games_are_not_found(self):
+        board = Board.from_history([(X, 0), (O, 3), (X, 1), (O, 4), (X, 2)])
+        self.assertIsNone(self.table.lookup(board))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""tournament.py - Offline round-robin and Swiss tournaments between bots.
+
+Games are played on engine.Board, the rules Game itself uses, without the
+datastore, and spread over a multiprocessing pool: every game is an
+independent task, so a tournament scales with the number of cores. Results
+are collected in bulk and can be written as NDJSON in the export format
+analysis.py reads, and optionally imported as Score entities with batched
+puts through remote_api.
+
+    python tournament.py ai random fast=ai:2000 [--format swiss --rounds 5]
+        [--games 2] [--size 3] [--win-length 3] [--processes 8]
+        [--output results.ndjson.gz]
+        [--import-scores HOST [--sdk path/to/google_appengine]]
+
+Players are given as [name=]kind[:node_budget], kinds are the keys of
+PLAYERS."""
+
+import argparse
+import collections
+import gzip
+import json
+import multiprocessing
+import random
+import time
+from datetime import date
+from datetime import datetime
+
+import ai
+from engine import Board
+from engine import O
+from engine import X
+from engine import other
+
+# The AI is limited by nodes only, so results don't depend on machine load
+AI_TIME_BUDGET = 60
+IMPORT_BATCH_SIZE = 500
+IMPORT_USER_PREFIX = 'bot:'
+POINTS = {'win': 2, 'tie': 1, 'loss': 0}  # as User.totlal_points
+
+
+def _random_player(board, letter, rng, nodes):
+    return rng.choice(list(board.free_cells()))
+
+
+def _greedy_player(board, letter, rng, nodes):
+    """Wins if it can, blocks if it must, otherwise plays at random"""
+    cells = list(board.free_cells())
+    for player in (letter, other(letter)):
+        for cell in cells:
+            won = board.play(cell, player)
+            board.undo(cell, player)
+            if won:
+                return cell
+    return rng.choice(cells)
+
+
+def _ai_player(board, letter, rng, nodes):
+    return ai.choose_move(board, letter, node_budget=nodes or ai.NODE_BUDGET,
+                          time_budget=AI_TIME_BUDGET)
+
+
+PLAYERS = {
+    'ai': _ai_player,
+    'greedy': _greedy_player,
+    'random': _random_player,
+}
+
+
+def parse_player(arg):
+    """Parses [name=]kind[:node_budget] into (name, kind, nodes)"""
+    name, _, spec = arg.rpartition('=')
+    kind, _, nodes = spec.partition(':')
+    if kind not in PLAYERS:
+        raise ValueError('Unknown player kind {!r}, expected one of {}'.format(
+            kind, ', '.join(sorted(PLAYERS))))
+    return name or spec, kind, int(nodes) if nodes else None
+
+
+def play_game(task):
+    """Plays one game. task is (x, o, size, win_length, seed) where x and o
+    are parsed players. Runs in the pool's worker processes."""
+    x, o, size, win_length, seed = task
+    board = Board(size, win_length)
+    rng = random.Random(seed)
+    history = []
+    letter = X
+    while not board.is_over:
+        _, kind, nodes = x if letter == X else o
+        cell = PLAYERS[kind](board, letter, rng, nodes)
+        board.play(cell, letter)
+        history.append(cell)
+        letter = other(letter)
+    if board.winner == X:
+        result = 'user_x'
+    elif board.winner == O:
+        result = 'user_o'
+    else:
+        result = 'tie'
+    return {'user_x': x[0], 'user_o': o[0], 'board_size': size,
+            'win_length': board.win_length, 'history': history,
+            'result': result, 'date': date.today().isoformat()}
+
+
+class Standings(object):
+    """Points (2 a win, 1 a tie), results and opponents per player"""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.points = dict.fromkeys(self.names, 0)
+        self.results = dict((name, collections.Counter())
+                            for name in self.names)
+        self.opponents = dict((name, set()) for name in self.names)
+        self.byes = set()
+
+    def add(self, game):
+        x, o = game['user_x'], game['user_o']
+        if game['result'] == 'tie':
+            outcomes = {x: 'tie', o: 'tie'}
+        else:
+            winner = x if game['result'] == 'user_x' else o
+            outcomes = {x: 'loss', o: 'loss'}
+            outcomes[winner] = 'win'
+        for name, outcome in outcomes.items():
+            self.points[name] += POINTS[outcome]
+            self.results[name][outcome] += 1
+        self.opponents[x].add(o)
+        self.opponents[o].add(x)
+
+    def add_bye(self, name, games):
+        self.points[name] += POINTS['win'] * games
+        self.byes.add(name)
+
+    def buchholz(self, name):
+        """Sum of the opponents' points, the Swiss tie-break"""
+        return sum(self.points[opponent] for opponent in self.opponents[name])
+
+    def ranking(self):
+        return sorted(self.names, key=lambda name: (
+            -self.points[name], -self.buchholz(name), name))
+
+    def report(self):
+        print('{:>4} {:20} {:>7} {:>5} {:>5} {:>5} {:>9}'.format(
+            'rank', 'player', 'points', 'won', 'tied', 'lost', 'buchholz'))
+        for rank, name in enumerate(self.ranking(), 1):
+            results = self.results[name]
+            print('{:>4} {:20} {:>7} {:>5} {:>5} {:>5} {:>9}'.format(
+                rank, name, self.points[name], results['win'],
+                results['tie'], results['loss'], self.buchholz(name)))
+
+
+class Tournament(object):
+    """Plays pairings of players over a process pool. Every pairing plays
+    `games` games with the players alternating X, so the first-move
+    advantage evens out."""
+
+    def __init__(self, players, size=3, win_length=None, games=2, seed=0,
+                 processes=None):
+        self.players = players
+        self.size = size
+        self.win_length = win_length
+        self.games = games
+        self.seed = seed
+        self.processes = processes or multiprocessing.cpu_count()
+        self.standings = Standings(player[0] for player in players)
+        self.results = []
+        self.pool = None
+
+    def __enter__(self):
+        if self.processes > 1:
+            self.pool = multiprocessing.Pool(self.processes)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def play(self, pairings):
+        """Plays every pairing and adds the games to the standings"""
+        tasks = []
+        for a, b in pairings:
+            for game in range(self.games):
+                x, o = (a, b) if game % 2 == 0 else (b, a)
+                tasks.append((x, o, self.size, self.win_length,
+                              self.seed * 1000003 + len(self.results) +
+                              len(tasks)))
+        if self.pool:
+            # a few chunks per worker keeps them busy without much IPC
+            chunksize = max(1, len(tasks) // (self.processes * 4))
+            games = self.pool.map(play_game, tasks, chunksize)
+        else:
+            games = [play_game(task) for task in tasks]
+        for game in games:
+            self.standings.add(game)
+        self.results.extend(games)
+        return games
+
+    def round_robin(self):
+        """Every player meets every other player once"""
+        self.play([(a, b) for i, a in enumerate(self.players)
+                   for b in self.players[i + 1:]])
+
+    def swiss(self, rounds):
+        """Each round pairs players with equal or close points who haven't
+        met yet; with an odd field the lowest player without a bye sits
+        out and scores a win per game."""
+        by_name = dict((player[0], player) for player in self.players)
+        rng = random.Random(self.seed)
+        for _ in range(rounds):
+            order = self.standings.ranking()
+            if not self.results:
+                rng.shuffle(order)
+            if len(order) % 2:
+                bye = next((name for name in reversed(order)
+                            if name not in self.standings.byes), order[-1])
+                order.remove(bye)
+                self.standings.add_bye(bye, self.games)
+            pairings = []
+            while order:
+                a = order.pop(0)
+                met = self.standings.opponents[a]
+                b = next((name for name in order if name not in met), order[0])
+                order.remove(b)
+                pairings.append((by_name[a], by_name[b]))
+            self.play(pairings)
+
+
+def write_results(results, path):
+    """Writes the games as NDJSON (gzipped for .gz paths)"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as out:
+        for game in results:
+            out.write((json.dumps(game) + '\n').encode('utf-8'))
+
+
+def import_scores(results, batch_size=IMPORT_BATCH_SIZE,
+                  prefix=IMPORT_USER_PREFIX):
+    """Stores the games as Score entities, IMPORT_BATCH_SIZE per put_multi.
+    Players are stored as Users named prefix + player name, created on first
+    use. Only Scores are written; User stats and the leaderboard are left
+    alone. Needs the App Engine APIs, e.g. after bulk.connect()."""
+    from google.appengine.ext import ndb
+    from models import Score
+    from models import User
+
+    keys = {}
+    for name in set(game[side] for game in results
+                    for side in ('user_x', 'user_o')):
+        username = prefix + name
+        key = User.get_key_by_name(username)
+        if not key:
+            try:
+                key = User.create(username).key
+            except ValueError:
+                key = User.get_key_by_name(username)
+        keys[name] = key
+
+    for start in range(0, len(results), batch_size):
+        ndb.put_multi([Score(user_x=keys[game['user_x']],
+                             user_o=keys[game['user_o']],
+                             result=game['result'],
+                             date=datetime.strptime(game['date'],
+                                                    '%Y-%m-%d').date())
+                       for game in results[start:start + batch_size]])
+    return len(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline tournaments between bots')
+    parser.add_argument('players', nargs='+',
+                        help='[name=]kind[:node_budget], kinds: ' +
+                        ', '.join(sorted(PLAYERS)))
+    parser.add_argument('--format', choices=('round-robin', 'swiss'),
+                        default='round-robin')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='rounds of a Swiss tournament')
+    parser.add_argument('--games', type=int, default=2,
+                        help='games per pairing, alternating X')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--win-length', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int,
+                        help='worker processes, one per core by default')
+    parser.add_argument('--output', help='write the games as NDJSON')
+    parser.add_argument('--import-scores', metavar='HOST',
+                        help='import the games as Scores into this app')
+    parser.add_argument('--sdk', help='path to the google_appengine SDK')
+    args = parser.parse_args()
+
+    try:
+        players = [parse_player(arg) for arg in args.players]
+    except ValueError as e:
+        parser.error(str(e))
+    if len(set(player[0] for player in players)) < len(players):
+        parser.error('Player names must be unique, use name=kind')
+
+    start = time.time()
+    with Tournament(players, args.size, args.win_length, args.games,
+                    args.seed, args.processes) as tournament:
+        if args.format == 'swiss':
+            tournament.swiss(args.rounds)
+        else:
+            tournament.round_robin()
+    elapsed = time.time() - start
+    print('{} games on {} processes in {:.1f}s'.format(
+        len(tournament.results), tournament.processes, elapsed))
+    tournament.standings.report()
+
+    if args.output:
+        write_results(tournament.results, args.output)
+    if args.import_scores:
+        from bulk import connect
+        connect(args.import_scores, args.sdk)
+        print('imported {} scores'.format(
+            import_scores(tournament.results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,47 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+from collections import OrderedDict
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+from engine import Board
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+def _parse_urlsafe(urlsafe):
+    try:
+        key = ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+    return key
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Parses a urlsafe key string without fetching the entity.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The ndb.Key the urlsafe Key string points to.
+    Raises:
+        endpoints.BadRequestException: If the key String is malformed or of
+        the incorrect kind."""
+    key = _parse_urlsafe(urlsafe)
+    if key.kind() != model._get_kind():
+        raise endpoints.BadRequestException('Invalid Key')
+    return key
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -17,16 +55,7 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
-
+    key = _parse_urlsafe(urlsafe)
     entity = key.get()
     if not entity:
         return None
@@ -34,25 +63,83 @@ def get_by_urlsafe(urlsafe, model):
         raise ValueError('Incorrect Kind')
     return entity
 
+
+def fetch_page(query, page_size=None, cursor=None, **options):
+    """Fetches one page of a query.
+    Args:
+        query: The ndb.Query to page through
+        page_size: Requested number of results, capped at MAX_PAGE_SIZE
+        cursor: Opaque urlsafe cursor returned with the previous page
+        options: Extra fetch options such as projection or keys_only
+    Returns:
+        A (results, next_cursor) tuple. next_cursor is None on the last page.
+    Raises:
+        endpoints.BadRequestException: If the cursor is malformed."""
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except (datastore_errors.BadValueError, TypeError):
+        raise endpoints.BadRequestException('Invalid cursor')
+    results, next_cursor, more = query.fetch_page(
+        page_size, start_cursor=start_cursor, **options)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+class LRUCache(object):
+    """A small thread-safe, size-bounded, in-process cache. Instances are
+    module level so they live as long as the App Engine instance."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_user_names(keys):
+    """Resolves User keys to names with a single batched get.
+    Args:
+        keys: An iterable of User keys, may contain duplicates or None
+    Returns:
+        A dict mapping each User key to the User's name."""
+    keys = list(set(key for key in keys if key))
+    users = ndb.get_multi(keys)
+    return dict((key, user.name) for key, user in zip(keys, users) if user)
+
+
 def isBoardFull(board):
-     # Return True if every space on the board has been taken. Otherwise return False.
-     for i in range(1, 10):
-         if isSpaceFree(board, i):
-             return False
-     return True
+    # Return True if every space on the board has been taken. Otherwise return False.
+    return all(board)
 
 
 def isSpaceFree(board, move):
-      # Return true if the passed move is free on the passed board.
+    # Return true if the passed move is free on the passed board.
     return board[move] == ''
 
-def isWinner(bo, le):
-    #Given a board and a players letter, this function returns True if that player has won
-      return ((bo[6] == le and bo[7] == le and bo[8] == le) or # across the top
-      (bo[3] == le and bo[4] == le and bo[5] == le) or # across the middle
-      (bo[0] == le and bo[1] == le and bo[2] == le) or # across the bottom
-      (bo[6] == le and bo[3] == le and bo[0] == le) or # down the left side
-      (bo[7] == le and bo[4] == le and bo[1] == le) or # down the middle
-      (bo[8] == le and bo[5] == le and bo[2] == le) or # down the right side
-      (bo[6] == le and bo[4] == le and bo[2] == le) or # diagonal
-      (bo[8] == le and bo[4] == le and bo[0] == le)) # diagonal
\ No newline at end of file
+def isWinner(bo, le, win_length=None):
+    # Given a board of any size and a players letter, this function returns
+    # True if that player has won
+    return Board.from_cells(bo, win_length=win_length).winner == le
@@ -0,0 +1,43 @@
+"""warmup.py - Handler for the /_ah/warmup requests App Engine sends to a
+new instance before routing user traffic to it (inbound_services in
+app.yaml). It does the work the first user request of the instance would
+otherwise pay for: importing endpoints, protorpc, the API and the models,
+building the service, filling the per-instance caches and loading the
+solved-position tables."""
+
+import logging
+import time
+
+import webapp2
+
+
+def warm_up():
+    """Loads the API and primes the caches of this instance"""
+    import ai
+    import api  # endpoints, protorpc, models and the service definition
+    import leaderboard
+    import solver
+    from models import User
+
+    # the players most likely to be looked up by name, and the computer
+    users = leaderboard.top_users()
+    User.cache_keys(users)
+    User.get_key_by_name(ai.AI_USER_NAME)
+    leaderboard.get_histogram()
+    tables = solver.load_tables()
+    return {'users': len(users), 'tables': len(tables)}
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Warm the instance up. Called by App Engine on instance start"""
+        start = time.time()
+        loaded = warm_up()
+        logging.info('Instance warmed up in %dms: %d user names, %d solved '
+                     'tables', (time.time() - start) * 1000,
+                     loaded['users'], loaded['tables'])
+
+
+app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
+])